@@ -4,39 +4,60 @@ import sys
 import os.path
 import re
 import struct
+import StringIO
+import time
+import array
+import bisect
+import copy
+import functools
+import hashlib
+import itertools
+import linecache
+import marshal
+import mmap
 import argparse
+import contextlib
+import json
+import resource
 
 
-srcs = {}
-filename = ''
-pos = 0
+class AsmError(Exception):
+    def __init__(self, msg, is_fatal=False):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.is_fatal = is_fatal
+        self.filename = None
+        self.pos = 0
+        self.line = None
 
 def fatal(msg):
-    prog = os.path.basename(sys.argv[0])
-    if sys.stderr.isatty():
-        print >> sys.stderr, '\x1b[1m{}: \x1b[31mfatal error:\x1b[39m'.format(prog), msg
-        sys.stderr.write('\x1b[0m')
-    else:
-        print >> sys.stderr, '{}: fatal error:'.format(prog), msg
-    sys.exit(1)
+    raise AsmError(msg, True)
 
 def error(msg):
+    raise AsmError(msg)
+
+def report(kind, color, msg, filename=None, pos=0, line=None):
+    if filename is None:
+        where = os.path.basename(sys.argv[0])
+    else:
+        where = '{}:{}'.format(filename, pos)
     if sys.stderr.isatty():
-        print >> sys.stderr, '\x1b[1m{}:{}: \x1b[31merror:\x1b[39m'.format(filename, pos), msg
+        print >> sys.stderr, '\x1b[1m{}: \x1b[{}m{}:\x1b[39m'.format(where, color, kind), msg
         sys.stderr.write('\x1b[0m')
     else:
-        print >> sys.stderr, '{}:{}: error:'.format(filename, pos), msg
-    print >> sys.stderr, '  ' + srcs[filename][pos]
-    sys.exit(1)
+        print >> sys.stderr, '{}: {}:'.format(where, kind), msg
+    if line is not None:
+        print >> sys.stderr, '  ' + line
 
-def warning(msg, show_line=False):
-    if sys.stderr.isatty():
-        print >> sys.stderr, '\x1b[1m{}:{}: \x1b[35mwarning:\x1b[39m'.format(filename, pos), msg
-        sys.stderr.write('\x1b[0m')
+def report_error(e):
+    if e.is_fatal:
+        report('fatal error', 31, e.msg)
     else:
-        print >> sys.stderr, '{}:{}: warning:'.format(filename, pos), msg
-    if show_line:
-        print >> sys.stderr, '  ' + srcs[filename][pos]
+        report('error', 31, e.msg, e.filename, e.pos, e.line)
+
+def report_warning(w):
+    filename, pos, msg, line = w
+    report('warning', 35, msg, filename, pos, line)
 
 
 # ----------------------------------------------------------------------
@@ -48,8 +69,10 @@ for i in range(32):
     regs['r' + str(i)] = i
 
 def regnum(reg):
+    if isinstance(reg, Reg):
+        return reg
     if reg not in regs:
-        error('expected register: ' + reg)
+        error('expected register: ' + str(reg))
     return regs[reg]
 
 def parse_int(s):
@@ -58,6 +81,76 @@ def parse_int(s):
     except ValueError:
         return False, 0
 
+# Operands of instructions are parsed once, when their line is expanded:
+# register names become Reg and integer literals Imm.  Both are ints which
+# print as written, so listings and messages show the source text.  Labels,
+# expressions and literals in any other notation (0X10, 010, +4, ...) stay
+# strings, as do all operands of directives.
+
+def format_operand(self, spec):
+    return format(str(self), spec)
+
+class Reg(int):
+    __slots__ = ()
+
+    def __str__(self):
+        return 'r%d' % self
+
+    __format__ = format_operand
+
+class RegAlias(Reg):
+    __slots__ = ()
+
+    def __str__(self):
+        return reg_aliases[self]
+
+class Imm(int):
+    # in decimal
+    __slots__ = ()
+
+    __format__ = format_operand
+
+class HexImm(Imm):
+    __slots__ = ()
+
+    def __str__(self):
+        return hex(self)
+
+reg_aliases = dict((i, name) for name, i in regs.items() if not name.startswith('r') or name[1:] != str(i))
+reg_operands = dict((name, RegAlias(i) if i in reg_aliases and reg_aliases[i] == name else Reg(i))
+                    for name, i in regs.items())
+
+operand_table = {}
+
+def parse_operand(s):
+    if s in reg_operands:
+        return reg_operands[s]
+    x = operand_table.get(s)
+    if x is None:
+        if len(operand_table) >= 0x10000:
+            operand_table.clear()
+        success, imm = parse_int(s)
+        try:
+            x = Imm(imm) if success and s == str(imm) else \
+                HexImm(imm) if success and s == hex(imm) else intern(s)
+        except OverflowError:
+            # too large for any operand; reported by the encoder
+            x = intern(s)
+        operand_table[s] = x
+    return x
+
+def parse_operands(mnemonic, operands):
+    if mnemonic[0] == '.' or mnemonic[-1] == ':':
+        return tuple(operands)
+    return tuple(map(parse_operand, operands))
+
+def operand_texts(lines):
+    # lines with the operands turned back into text, for marshal
+    return [(mnemonic, type(operands)(map(str, operands)), filename, pos) for mnemonic, operands, filename, pos in lines]
+
+def parse_lines(lines):
+    return [(mnemonic, parse_operands(mnemonic, operands), filename, pos) for mnemonic, operands, filename, pos in lines]
+
 def parse_float(s):
     try:
         return True, float(s)
@@ -100,6 +193,10 @@ def check_operands_n(operands, n, m=-1):
         error('expected {} operands, but {} given'.format(max(n, m), l))
 
 def split_comma(s):
+    if '"' not in s and '#' not in s:
+        return s.split(',')
+    ret = []
+    start = 0
     lit = esc = False
     for i, c in enumerate(s):
         if esc:
@@ -110,10 +207,13 @@ def split_comma(s):
         if c == '\\' and lit:
             esc = True
         if c == ',' and not lit:
-            return [s[0:i]] + split_comma(s[i+1:])
+            ret.append(s[start:i])
+            start = i + 1
         if c == '#' and not lit:
-            return [s[0:i]]
-    return [s]
+            ret.append(s[start:i])
+            return ret
+    ret.append(s[start:])
+    return ret
 
 def parse(line):
     mnemonic, rest = line.split(None, 1) if ' ' in line else (line, '')
@@ -124,6 +224,13 @@ def parse(line):
     operands = split_comma(rest)
     return mnemonic, map(str.strip, operands)
 
+def read_lines(filename, digest=None):
+    with open(filename, 'rb') as f:
+        for line in f:
+            if digest:
+                digest.update(line)
+            yield line
+
 
 # ----------------------------------------------------------------------
 #       mnemonic definitions
@@ -202,97 +309,170 @@ sign_table = {
     'abs.neg':   3,
 }
 
-def code_i(op, rx, ra, rb, imm, tag):
-    x = regnum(rx)
-    a = regnum(ra)
-    b = regnum(rb)
-    success, i = parse_int(imm)
-    if not success:
-        error('expected integer literal: ' + imm)
-    if not check_int_range(i, 8):
-        error('immediate value too large: ' + imm)
-    c0 = ((i & 7) << 5) + tag
-    c1 = ((b & 7) << 5) + ((i >> 3) & 31)
-    c2 = ((x & 1) << 7) + (a << 2) + (b >> 3)
-    c3 = (op << 4) + (x >> 1)
-    return chr(c0) + chr(c1) + chr(c2) + chr(c3)
-
-def code_f(rx, ra, rb, sign, tag):
-    x = regnum(rx)
-    a = regnum(ra)
-    b = regnum(rb)
-    c0 = (sign << 5) + tag
-    c1 = ((b & 7) << 5)
-    c2 = ((x & 1) << 7) + (a << 2) + (b >> 3)
-    c3 = (1 << 4) + (x >> 1)
-    return chr(c0) + chr(c1) + chr(c2) + chr(c3)
-
-def code_m(op, rx, ra, pred, disp, disp_mode):
-    x = regnum(rx)
-    a = regnum(ra)
-    success, d = parse_int(disp)
-    if not success:
-        error('expected displacement: ' + disp)
+word = struct.Struct('<I')
+
+# Besides Reg and Imm, operands computed by resolve_label() arrive as
+# plain ints, which are shown in hex.
+
+def operand_str(operand):
+    if isinstance(operand, (str, Reg, Imm)):
+        return str(operand)
+    return hex(operand).rstrip('L')
+
+def imm_operand(imm, msg):
+    if isinstance(imm, str):
+        try:
+            return int(imm, 0)
+        except ValueError:
+            error(msg + imm)
+    if isinstance(imm, Reg):
+        error(msg + str(imm))
+    return imm
+
+def check_disp(d, disp, disp_mode):
     if disp_mode == 0:
         if not -0x8000 <= d <= 0xffff:
-            error('immediate value too large: ' + disp)
+            error('immediate value too large: ' + operand_str(disp))
     elif disp_mode == 1:
-        if not check_int_range(d, 16):
-            error('displacement too large: ' + disp)
+        if not -0x8000 <= d < 0x8000:
+            error('displacement too large: ' + operand_str(disp))
     else:
         if d & 3 != 0:
             error('displacement must be a multiple of 4')
-        if not check_int_range(d, 18):
-            error('displacement too large: ' + disp)
+        if not -0x20000 <= d < 0x20000:
+            error('displacement too large: ' + operand_str(disp))
         d >>= 2
-    c0 = d & 255
-    c1 = (d >> 8) & 255
-    c2 = ((x & 1) << 7) + (a << 2) + pred
-    c3 = (op << 4) + (x >> 1)
-    return chr(c0) + chr(c1) + chr(c2) + chr(c3)
-
-def on_alu3(operands, tag):
-    check_operands_n(operands, 3)
-    return code_i(0, operands[0], operands[1], operands[2], '0', tag)
-
-def on_alu4(operands, tag):
-    check_operands_n(operands, 4)
-    return code_i(0, operands[0], operands[1], operands[2], operands[3], tag)
-
-def on_fpu2(operands, sign, tag):
-    check_operands_n(operands, 2)
-    return code_f(operands[0], operands[1], 'r0', sign, tag)
-
-def on_fpu3(operands, sign, tag):
-    check_operands_n(operands, 3)
-    return code_f(operands[0], operands[1], operands[2], sign, tag)
-
-def on_misc0(operands, op, pred, disp_mode):
-    check_operands_n(operands, 0)
-    return code_m(op, 'r0', 'r0', pred, '0', disp_mode)
-
-def on_misc2(operands, op, pred, disp_mode):
-    check_operands_n(operands, 2)
-    return code_m(op, operands[0], 'r0', pred, operands[1], disp_mode)
-
-def on_misc3(operands, op, pred, disp_mode):
-    check_operands_n(operands, 3)
-    return code_m(op, operands[0], operands[1], pred, operands[2], disp_mode)
-
-def on_jr(operands):
+    return d & 0xffff
+
+# The encoders below build the instruction word directly:
+#   ALU   op(4) rx(5) ra(5) rb(5) imm(8) tag(5)
+#   FPU   op(4) rx(5) ra(5) rb(5) 000 sign(2) tag(5)
+#   misc  op(4) rx(5) ra(5) pred(2) disp(16)
+# Operands parsed at expansion are taken as they are; anything else goes
+# through regnum() and imm_operand(), which report what is wrong.
+
+def enc_alu3(tag):
+    def enc(operands):
+        if len(operands) != 3:
+            check_operands_n(operands, 3)
+        x, a, b = operands
+        if not (isinstance(x, Reg) and isinstance(a, Reg) and isinstance(b, Reg)):
+            x, a, b = regnum(x), regnum(a), regnum(b)
+        return x << 23 | a << 18 | b << 13 | tag
+    return enc
+
+def enc_alu4(tag):
+    def enc(operands):
+        if len(operands) != 4:
+            check_operands_n(operands, 4)
+        x, a, b, imm = operands
+        if not (isinstance(x, Reg) and isinstance(a, Reg) and isinstance(b, Reg)):
+            x, a, b = regnum(x), regnum(a), regnum(b)
+        i = imm if isinstance(imm, Imm) else imm_operand(imm, 'expected integer literal: ')
+        if not -128 <= i < 128:
+            error('immediate value too large: ' + operand_str(imm))
+        return x << 23 | a << 18 | b << 13 | (i & 255) << 5 | tag
+    return enc
+
+def enc_fpu2(sign, tag):
+    base = 1 << 28 | sign << 5 | tag
+    def enc(operands):
+        if len(operands) != 2:
+            check_operands_n(operands, 2)
+        x, a = operands
+        if not (isinstance(x, Reg) and isinstance(a, Reg)):
+            x, a = regnum(x), regnum(a)
+        return base | x << 23 | a << 18
+    return enc
+
+def enc_fpu3(sign, tag):
+    base = 1 << 28 | sign << 5 | tag
+    def enc(operands):
+        if len(operands) != 3:
+            check_operands_n(operands, 3)
+        x, a, b = operands
+        if not (isinstance(x, Reg) and isinstance(a, Reg) and isinstance(b, Reg)):
+            x, a, b = regnum(x), regnum(a), regnum(b)
+        return base | x << 23 | a << 18 | b << 13
+    return enc
+
+def enc_misc0(op):
+    base = op << 28
+    def enc(operands):
+        check_operands_n(operands, 0)
+        return base
+    return enc
+
+def enc_misc2(op, pred, disp_mode):
+    base = op << 28 | pred << 16
+    def enc(operands):
+        if len(operands) != 2:
+            check_operands_n(operands, 2)
+        x, disp = operands
+        if not isinstance(x, Reg):
+            x = regnum(x)
+        d = disp if isinstance(disp, Imm) or type(disp) is int else imm_operand(disp, 'expected displacement: ')
+        return base | x << 23 | check_disp(d, disp, disp_mode)
+    return enc
+
+def enc_misc3(op, pred, disp_mode):
+    base = op << 28 | pred << 16
+    def enc(operands):
+        if len(operands) != 3:
+            check_operands_n(operands, 3)
+        x, a, disp = operands
+        if not (isinstance(x, Reg) and isinstance(a, Reg)):
+            x, a = regnum(x), regnum(a)
+        d = disp if isinstance(disp, Imm) or type(disp) is int else imm_operand(disp, 'expected displacement: ')
+        return base | x << 23 | a << 18 | check_disp(d, disp, disp_mode)
+    return enc
+
+def enc_jr(operands):
     check_operands_n(operands, 2)
-    return code_m(5, operands[0], operands[1], 3, '0', 0)
-
-def on_debug(operands, tag):
-    check_operands_n(operands, 1)
-    return code_m(10, 'r{}'.format(tag), 'r0', 0, operands[0], 0)
+    x, a = regnum(operands[0]), regnum(operands[1])
+    return 5 << 28 | x << 23 | a << 18 | 3 << 16
+
+def enc_debug(tag):
+    base = 10 << 28 | tag << 23
+    def enc(operands):
+        check_operands_n(operands, 1)
+        disp = operands[0]
+        d = imm_operand(disp, 'expected displacement: ')
+        return base | check_disp(d, disp, 0)
+    return enc
+
+def make_encode_table():
+    table = {'jr': enc_jr}
+    for mnemonic, tag in alu3_table.items():
+        table[mnemonic] = enc_alu3(tag)
+    for mnemonic, tag in alu4_table.items():
+        table[mnemonic] = enc_alu4(tag)
+    for suffix, sign in sign_table.items():
+        dot = '.' + suffix if suffix else ''
+        for mnemonic, tag in fpu2_table.items():
+            table[mnemonic + dot] = enc_fpu2(sign, tag)
+        for mnemonic, tag in fpu3_table.items():
+            table[mnemonic + dot] = enc_fpu3(sign, tag)
+    for mnemonic, op in misc0_table.items():
+        table[mnemonic] = enc_misc0(op)
+    table['ldl'] = enc_misc2(misc2_table['ldl'], 0, 0)
+    table['jl'] = enc_misc2(misc2_table['jl'], 3, 2)
+    for mnemonic, op in misc3_table.items():
+        disp_mode = 0 if mnemonic == 'ldh' else 1 if mnemonic in ['ldb', 'stb'] else 2
+        table[mnemonic] = enc_misc3(op, 0, disp_mode)
+    for mnemonic in ['bne', 'beq']:
+        table[mnemonic + '-'] = enc_misc3(misc3_table[mnemonic], 0, 2)
+        table[mnemonic + '+'] = enc_misc3(misc3_table[mnemonic], 3, 2)
+    for mnemonic, tag in debug_table.items():
+        table[mnemonic] = enc_debug(tag)
+    return table
+
+encode_table = make_encode_table()
 
 def on_dot_int(operand):
-    success, imm = parse_int(operand)
-    if not success:
-        error('expected integer literal: ' + operand)
+    imm = imm_operand(operand, 'expected integer literal: ')
     if not -0x80000000 <= imm <= 0xffffffff:
-        error('immediate value too large: ' + operand)
+        error('immediate value too large: ' + operand_str(operand))
     return ''.join(chr(imm >> x & 255) for x in [0, 8, 16, 24])
 
 def on_dot_byte(operand):
@@ -317,47 +497,74 @@ def on_dot_space(operands):
     if not success:
         error('expected integer literal: ' + operands[1])
     if not -128 <= imm <= 255:
-        error('immediate value too large: ' + operand)
+        error('immediate value too large: ' + operands[1])
     size = int(operands[0], 0)
     return ''.ljust(size, chr(imm & 255))
 
+int_literal = functools.partial(int, base=0)
+
+def pack_data(operands, size, on_operand):
+    # .byte/.short/.int lists are converted as a whole; on_operand() is
+    # only used to report the operand which is not a valid literal.  The
+    # .int lists from resolve_label() are ints already
+    try:
+        vals = map(int_literal, operands) if operands and isinstance(operands[0], str) else operands
+    except ValueError:
+        vals = None
+    bits = size * 8
+    if not vals or min(vals) < -(1 << bits - 1) or max(vals) >= 1 << bits:
+        return ''.join(on_operand(operand) for operand in operands)
+    if min(vals) < 0:
+        vals = [val & (1 << bits) - 1 for val in vals]
+    if size == 1:
+        return str(bytearray(vals))
+    return struct.pack('<{}{}'.format(len(vals), 'H' if size == 2 else 'I'), *vals)
+
+def incbin(operands):
+    # file, offset and length of an .incbin line; a negative length
+    # stands for the rest of the file
+    path = eval_string(operands[0])
+    offset, length = int(operands[1], 0), int(operands[2], 0)
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        error('cannot open file: ' + path)
+    if not 0 <= offset <= size:
+        error('offset out of range: ' + operands[1])
+    if length < 0:
+        length = size - offset
+    if offset + length > size:
+        error('length out of range: ' + operands[2])
+    return path, offset, length
+
+def on_dot_incbin(operands):
+    path, offset, length = incbin(operands)
+    if length == 0:
+        return ''
+    with open(path, 'rb') as f:
+        m = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return m[offset:offset + length]
+        finally:
+            m.close()
+
 def code(mnemonic, operands):
-    if mnemonic in alu3_table:
-        return on_alu3(operands, alu3_table[mnemonic])
-    if mnemonic in alu4_table:
-        return on_alu4(operands, alu4_table[mnemonic])
-    fpu_mnemonic, fpu_suffix = mnemonic, ''
-    if '.' in mnemonic:
-        fpu_mnemonic, fpu_suffix = mnemonic.split('.', 1)
-    if fpu_mnemonic in fpu2_table:
-        return on_fpu2(operands, sign_table[fpu_suffix], fpu2_table[fpu_mnemonic])
-    if fpu_mnemonic in fpu3_table:
-        return on_fpu3(operands, sign_table[fpu_suffix], fpu3_table[fpu_mnemonic])
-    pred = 3 if mnemonic in ['jl', 'bne+', 'beq+'] else 0
-    disp_mode = 0 if mnemonic in ['ldl', 'ldh'] else \
-                1 if mnemonic in ['ldb', 'stb'] else 2
-    if mnemonic in ['bne-', 'bne+']:
-        mnemonic = 'bne'
-    if mnemonic in ['beq-', 'beq+']:
-        mnemonic = 'beq'
-    if mnemonic in misc0_table:
-        return on_misc0(operands, misc0_table[mnemonic], pred, disp_mode)
-    if mnemonic in misc2_table:
-        return on_misc2(operands, misc2_table[mnemonic], pred, disp_mode)
-    if mnemonic in misc3_table:
-        return on_misc3(operands, misc3_table[mnemonic], pred, disp_mode)
-    if mnemonic == 'jr':
-        return on_jr(operands)
-    if mnemonic in debug_table:
-        return on_debug(operands, debug_table[mnemonic])
+    if mnemonic in encode_table:
+        return word.pack(encode_table[mnemonic](operands))
     if mnemonic == '.int':
-        return ''.join(on_dot_int(operand) for operand in operands)
+        return pack_data(operands, 4, on_dot_int)
     if mnemonic == '.byte':
-        return ''.join(on_dot_byte(operand) for operand in operands)
+        return pack_data(operands, 1, on_dot_byte)
     if mnemonic == '.short':
-        return ''.join(on_dot_short(operand) for operand in operands)
+        return pack_data(operands, 2, on_dot_short)
     if mnemonic == '.space':
         return on_dot_space(operands)
+    if mnemonic == '.incbin':
+        return on_dot_incbin(operands)
+    if mnemonic == '.zero':
+        return '\0' * int(operands[0], 0)
+    if mnemonic in ['.code', '.data']:
+        return operands[0]
     error('unknown mnemonic \'{}\''.format(mnemonic))
 
 
@@ -371,6 +578,8 @@ def eval_string(arg):
         if not isinstance(s, str):
             error('expected string literal: ' + arg)
         return s
+    except AsmError:
+        raise
     except Exception:
         error('invalid string literal: ' + arg)
 
@@ -616,7 +825,12 @@ def expand_dot_float(operands):
         if not success:
             error('expected floating point literal: ' + operand)
         return hex(float_to_bit(floimm))
-    return [('.int', map(go, operands))]
+    n = len(operands)
+    try:
+        bits = struct.unpack('<{}I'.format(n), struct.pack('<{}f'.format(n), *map(float, operands)))
+    except (ValueError, OverflowError, struct.error):
+        return [('.int', map(go, operands))]
+    return [('.int', map(hex, bits))]
 
 def expand_dot_space(operands):
     check_operands_n(operands, 1, 2)
@@ -624,10 +838,27 @@ def expand_dot_space(operands):
         return [('.space', operands)]
     return [('.space', [operands[0], '0'])]
 
+def expand_dot_zero(operands):
+    check_operands_n(operands, 1)
+    success, imm = parse_int(operands[0])
+    if not success:
+        error('expected integer literal: ' + operands[0])
+    if imm < 0:
+        error('size must not be negative: ' + operands[0])
+    return [('.zero', operands)]
+
 def expand_dot_string(operands):
     check_operands_n(operands, 1)
     s = eval_string(operands[0])
-    return [('.byte', [str(ord(c)) for c in s] + ['0'])]
+    return [('.byte', map(str, bytearray(s)) + ['0'])]
+
+def expand_dot_incbin(operands):
+    check_operands_n(operands, 1, 3)
+    eval_string(operands[0])
+    for operand in operands[1:]:
+        if not parse_int(operand)[0]:
+            error('expected integer literal: ' + operand)
+    return [('.incbin', operands + ['0', '-1'][len(operands) - 1:])]
 
 macro_table = {
     'nop':      expand_nop,
@@ -652,9 +883,12 @@ macro_table = {
     'enter':    expand_enter,
     'leave':    expand_leave,
     'halt':     expand_halt,
+    '.bss':     expand_dot_zero,
     '.float':   expand_dot_float,
+    '.incbin':  expand_dot_incbin,
     '.space':   expand_dot_space,
     '.string':  expand_dot_string,
+    '.zero':    expand_dot_zero,
 }
 
 def expand_macro(line):
@@ -683,19 +917,56 @@ def expand_macro(line):
             return expand_bfne(br_mnemonic, operands, pred)
     return [(mnemonic, operands)]
 
+class ExpansionCache(object):
+    # Bounded cache of expand_macro() results keyed by the stripped source
+    # line; compiler output repeats the same lines over and over.  Results
+    # are kept as tuples of (mnemonic, parsed operand tuple) and must not be
+    # modified.  Entries live in two generations: a hit in the old one
+    # moves the entry to the current one, and the old generation is dropped
+    # when the current one is full, so recently used lines stay cached.
+    def __init__(self, size=0x4000):
+        self.size = size
+        self.clear()
+
+    def clear(self):
+        self.new = {}
+        self.old = {}
+        self.hits = 0
+        self.misses = 0
+
+    def expand(self, line):
+        if len(line) > 0x100:
+            # long lines are data tables, which hardly ever repeat
+            return [(x, parse_operands(x, y)) for x, y in expand_macro(line)]
+        ret = self.new.get(line)
+        if ret is not None:
+            self.hits += 1
+            return ret
+        ret = self.old.get(line)
+        if ret is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            ret = tuple((x, parse_operands(x, y)) for x, y in expand_macro(line))
+        if len(self.new) >= self.size:
+            self.old, self.new = self.new, {}
+        self.new[line] = ret
+        return ret
+
+expansion_cache = ExpansionCache()
+
 
 # ----------------------------------------------------------------------
 #       label resolution
 # ----------------------------------------------------------------------
 
-labels = {}
-rev_labels = {}
-library = []
-entry_point = 0x2000
-start_label = 'main'
-
 ofs_table = {
     'mov':       8,
+    'mov1':      4,
+    'ld1':       4,
+    'ldb1':      4,
+    'st1':       4,
+    'stb1':      4,
     'ld2':       8,
     'ldb2':      8,
     'st2':       8,
@@ -705,62 +976,65 @@ ofs_table = {
     'call7':    28,
 }
 
-def add_label(label, i):
-    if label in regs:
-        error('\'{}\' is register name'.format(label))
-    if parse_int(label)[0]:
-        error('\'{}\' can be parsed as integer'.format(label))
-    if re.search(r'[^\w.$!?]', label):
-        c = re.search(r'[^\w.$!?]', label).group()
-        error('label name cannot contain \'{}\' character'.format(c))
-    labels.setdefault(label, {}).setdefault(filename, [-1, False, False])
-    if labels[label][filename][0] >= 0:
-        error('duplicate declaration of label \'{}\''.format(label))
-    labels[label][filename][0] = i
-    rev_labels.setdefault(i, []).append(label)
-
-def add_global(label):
-    labels.setdefault(label, {}).setdefault(filename, [-1, False, False])
-    labels[label][filename][1] = True
-
-def label_addr(label):
-    dic = labels.get(label, {})
-    if filename in dic:
-        decl = [filename]
-    else:
-        decl = filter(lambda x: dic[x][1], dic)
-    if len(decl) == 0:
-        if label == start_label:
-            fatal('global label \'{}\' is required'.format(label))
-        else:
-            error('label \'{}\' is not declared'.format(label))
-    if len(decl) > 1 and not set(decl) <= set(library):
-        decl = list(set(decl) - set(library))
-    if len(decl) > 1:
-        msg = 'label \'{}\' is declared in multiple files ({})'.format(label, ', '.join(sorted(decl)))
-        if label == start_label:
-            fatal(msg)
-        else:
-            error(msg)
-    dic[decl[0]][2] = True
-    return dic[decl[0]][0]
-
-def eval_expr(expr):
-    r = re.compile(r'[\w.$!?]+')
-    m = r.search(expr)
-    while m:
-        success, imm = parse_int(m.group())
-        if not success:
-            addr = str(label_addr(m.group()))
-            expr = expr[:m.start()] + addr + expr[m.end():]
-        m = r.search(expr, m.end() if success else m.start() + len(addr))
+shrink_table = {
+    'mov':      'mov1',
+    'ld2':      'ld1',
+    'ldb2':     'ldb1',
+    'st2':      'st1',
+    'stb2':     'stb1',
+    'call':     'call6',
+}
+
+grow_table = {
+    'mov1':     'mov',
+    'ld1':      'ld2',
+    'ldb1':     'ldb2',
+    'st1':      'st2',
+    'stb1':     'stb2',
+    'call6':    'call7',
+    'call7':    'call',
+}
+
+# Expressions are Python expressions over integer literals and labels.  Each
+# operand string is compiled once: label tokens become _[i], which is bound to
+# the list of label addresses when the expression is evaluated.
+
+expr_token = re.compile(r'[\w.$!?]+')
+expr_cache = {}
+
+def compile_expr(expr):
+    names = []
+    def label_slot(m):
+        if parse_int(m.group())[0]:
+            return m.group()
+        names.append(m.group())
+        return '_[{}]'.format(len(names) - 1)
     try:
-        res = eval(expr, {})
-        if not isinstance(res, int):
-            error('expression type must be int')
-        return res
-    except Exception:
-        error('eval error: ' + expr)
+        code = compile(expr_token.sub(label_slot, expr), '<expr>', 'eval')
+    except SyntaxError:
+        code = None
+    return code, names
+
+def substitute_expr(expr, addrs):
+    addrs = iter(addrs)
+    return expr_token.sub(lambda m: m.group() if parse_int(m.group())[0] else str(next(addrs)), expr)
+
+# label-dependent mnemonics left unencoded in object files
+reloc_mnemonics = ['.global', '.set', '.align', '.space', '.zero', '.incbin', 'mov', 'ld2', 'ldb2', 'st2', 'stb2', 'call']
+
+branch_mnemonics = ['jl', 'bne', 'bne-', 'bne+', 'beq', 'beq-', 'beq+']
+
+def is_label(operand):
+    # the target of a branch; integer literals too large for an Imm are
+    # left for the encoder to report
+    return isinstance(operand, str) and not parse_int(operand)[0]
+
+# the instructions around the jump of a call
+call_pre = [(x, parse_operands(x, y)) for x, y in [('st', ['rbp', 'rsp', '-4']),
+                                                   ('sub', ['rsp', 'rsp', 'r0', '4']),
+                                                   ('add', ['rbp', 'rsp', 'r0', '0'])]]
+call_post = [(x, parse_operands(x, y)) for x, y in [('add', ['rsp', 'rbp', 'r0', '4']),
+                                                    ('ld', ['rbp', 'rsp', '-4'])]]
 
 def calc_ofs(mnemonic, operands, addr=0):
     if mnemonic[-1] == ':' or mnemonic in ['.global', '.set']:
@@ -770,314 +1044,1085 @@ def calc_ofs(mnemonic, operands, addr=0):
         return ((addr + align - 1) & ~(align - 1)) - addr
     if mnemonic == '.byte':
         return len(operands)
+    if mnemonic == '.incbin':
+        return incbin(operands)[2]
     if mnemonic == '.int':
         return 4 * len(operands)
     if mnemonic == '.short':
         return 2 * len(operands)
-    if mnemonic == '.space':
+    if mnemonic in ['.space', '.zero']:
         return int(operands[0], 0)
+    if mnemonic in ['.code', '.data']:
+        return len(operands[0])
     return ofs_table.get(mnemonic, 4)
 
-def init_label_first(lines):
-    global labels, rev_labels, filename, pos
-    labels = {}
-    rev_labels = {}
-    addr = entry_point
-    for mnemonic, operands, filename, pos in lines:
-        if mnemonic[-1] == ':':
-            if len(operands) > 0:
-                error('label declaration must be followed by new line')
-            add_label(mnemonic[:-1], addr)
-        elif mnemonic == '.align':
-            check_operands_n(operands, 1)
-            success, imm = parse_int(operands[0])
-            if not success:
-                error('expected integer literal: ' + operands[0])
-            if imm < 4 or (imm & (imm - 1)) > 0:
-                error('alignment must be a power of 2 which is not less than 4')
-            addr += ((addr + imm - 1) & ~(imm - 1)) - addr
-        elif mnemonic == '.byte':
-            addr += len(operands)
-        elif mnemonic == '.global':
-            check_operands_n(operands, 1)
-            add_global(operands[0])
-        elif mnemonic == '.int':
-            addr += 4 * len(operands)
-        elif mnemonic == '.set':
-            check_operands_n(operands, 2)
-            add_label(operands[0], eval_expr(operands[1]))
-        elif mnemonic == '.short':
-            addr += 2 * len(operands)
-        elif mnemonic == '.space':
-            check_operands_n(operands, 2)
-            success, imm = parse_int(operands[0])
-            if not success:
-                error('expected integer literal: ' + operands[0])
-            addr += imm
-        else:
-            if addr & 3:
-                error('instruction must be aligned on 4-byte boundaries')
-            addr += ofs_table.get(mnemonic, 4)
-
-def init_label(lines):
-    global labels, rev_labels, filename, pos
-    labels = {}
-    rev_labels = {}
-    addr = entry_point
-    for mnemonic, operands, filename, pos in lines:
-        if mnemonic[-1] == ':':
-            add_label(mnemonic[:-1], addr)
-        elif mnemonic == '.global':
-            add_global(operands[0])
-        elif mnemonic == '.set':
-            add_label(operands[0], eval_expr(operands[1]))
-        else:
-            addr += calc_ofs(mnemonic, operands, addr)
-
-def optimize(lines):
-    global filename, pos
-    eff = 0
-    addr = entry_point
-    for i, (mnemonic, operands, filename, pos) in enumerate(lines):
-        if mnemonic == 'mov':
-            addr += 8
-            if check_int_range(eval_expr(operands[1]), 16):
-                eff += 4
-                lines[i] = ('mov1', operands, filename, pos)
-        elif mnemonic in ['ld2', 'st2']:
-            addr += 8
-            if check_int_range(eval_expr(operands[1]), 18):
-                eff += 4
-                lines[i] = (mnemonic[:2] + '1', operands, filename, pos)
-        elif mnemonic in ['ldb2', 'stb2']:
-            addr += 8
-            if check_int_range(eval_expr(operands[1]), 16):
-                eff += 4
-                lines[i] = (mnemonic[:3] + '1', operands, filename, pos)
-        elif mnemonic in ['call', 'call7']:
-            val = label_addr(operands[0])
-            if check_int_range(val - addr - 16 + (eff if val > addr else -eff), 18):
-                eff += ofs_table[mnemonic] - 24
-                lines[i] = ('call6', operands, filename, pos)
-            elif mnemonic == 'call' and check_int_range(val, 16):
-                eff += 4
-                lines[i] = ('call7', operands, filename, pos)
-            addr += ofs_table[mnemonic]
-        else:
-            addr += calc_ofs(mnemonic, operands, addr)
-    return eff > 0
-
-def resolve_label(lines):
-    global filename, pos
-    ret = []
-    addr = entry_point
-    for mnemonic, operands, filename, pos in lines:
-        if mnemonic[-1] == ':' or mnemonic in ['.global', '.set']:
-            continue
-        if mnemonic == 'mov1':
-            addr += 4
-            ret.append(('ldl', [operands[0], hex(eval_expr(operands[1]))], filename, pos))
-            continue
-        if mnemonic == 'mov':
-            addr += 8
-            val = eval_expr(operands[1])
-            if not -0x80000000 <= val <= 0xffffffff:
-                if not filename:
-                    fatal('address of start label is too large: ' + hex(val))
-                else:
-                    error('expression value too large: ' + hex(val))
-            ret.append(('ldl', [operands[0], hex(val & 0xffff)], filename, pos))
-            ret.append(('ldh', [operands[0], operands[0], hex(val >> 16 & 0xffff)], filename, pos))
-            continue
-        if mnemonic in ['ld1', 'ldb1', 'st1', 'stb1']:
-            addr += 4
-            ret.append((mnemonic[:-1], [operands[0], 'r0', hex(eval_expr(operands[1]))], filename, pos))
-            continue
-        if mnemonic in ['ld2', 'ldb2', 'st2', 'stb2']:
-            addr += 8
-            val = eval_expr(operands[1])
-            if not -0x80000000 <= val <= 0xffffffff:
-                error('expression value too large: ' + hex(val))
-            hi, lo = (val + 0x8000) >> 16 & 0xffff, ((val + 0x8000) & 0xffff) - 0x8000
-            ret.append(('ldh', ['r29', 'r0', hex(hi)], filename, pos))
-            ret.append((mnemonic[:-1], [operands[0], 'r29', hex(lo)], filename, pos))
-            continue
-        if mnemonic in ['call', 'call6', 'call7']:
-            addr += ofs_table[mnemonic]
-            val = label_addr(operands[0])
-            if not -0x80000000 <= val <= 0xffffffff:
-                error('expression value too large: ' + hex(val))
-            pre = [('st', ['rbp', 'rsp', '-4']),
-                   ('sub', ['rsp', 'rsp', 'r0', '4']),
-                   ('add', ['rbp', 'rsp', 'r0', '0'])]
-            if mnemonic == 'call6':
-                mid = [('jl', ['r28', hex(val - addr + 8)])]
-            else:
-                if mnemonic == 'call7':
-                    mid = [('ldl', ['r29', hex(val)])]
-                else:
-                    mid = [('ldl', ['r29', hex(val & 0xffff)]),
-                           ('ldh', ['r29', 'r29', hex(val >> 16 & 0xffff)])]
-                mid.append(('jr', ['r28', 'r29']))
-            post = [('add', ['rsp', 'rbp', 'r0', '4']), ('ld', ['rbp', 'rsp', '-4'])]
-            ret.extend(map(lambda (x, y): (x, y, filename, pos), pre + mid + post))
-            continue
-        if mnemonic == '.align':
-            align = int(operands[0], 0)
-            padding = ((addr + align - 1) & ~(align - 1)) - addr
-            if padding:
-                addr += padding
-                ret.append(('.space', [str(padding), '0'],filename, pos))
-            continue
-        if mnemonic in ['jl', 'bne', 'bne-', 'bne+', 'beq', 'beq-', 'beq+']:
-            check_operands_n(operands, 2, 3)
-            if not parse_int(operands[-1])[0]:
-                operands[-1] = hex(label_addr(operands[-1]) - addr - 4)
-        if mnemonic == '.int':
-            def go(operand):
-                val = eval_expr(operand)
-                if not -0x80000000 <= val <= 0xffffffff:
-                    error('expression value too large: ' + hex(val))
-                return str(val) if check_int_range(val, 8) else hex(val)
-            operands = map(go, operands)
-        addr += calc_ofs(mnemonic, operands)
-        ret.append((mnemonic, operands, filename, pos))
-    if addr - entry_point > 0x400000:
-        fatal('program size exceeds 4MB limit ({:,} bytes)'.format(addr - entry_point))
-    return ret
-
-def check_global(label):
-    if labels[label][filename][0] < 0:
-        error('label \'{}\' is not declared'.format(label))
-
-def warn_unused_label(label):
-    if not labels[label][filename][2] and not (filename in library and labels[label][filename][1]):
-        warning('unused label \'{}\''.format(label))
-
-def show_label(i):
-    if i in rev_labels:
-        return format(', '.join(rev_labels[i]))
-    return ''
+def file_stamps(paths):
+    # (path, (mtime, size)) of each file, or None if one is missing
+    try:
+        return [(path, (st.st_mtime, st.st_size)) for path, st in zip(paths, map(os.stat, paths))]
+    except OSError:
+        return None
+
+def same_segment(checkpoint, tag):
+    # whether a segment laid out in the last build is there unchanged
+    stamps = checkpoint[7]
+    return tag is not None and checkpoint[0] is tag and stamps is not None and \
+           file_stamps([path for path, _ in stamps]) == stamps
+
+def copied_lines(image, start, length, zeros, filename):
+    # a segment of the last image, with its .zero areas left to encode()
+    pos = 0
+    for ofs, n in zeros:
+        if ofs > pos:
+            yield '.data', [str(image[start + pos:start + ofs])], filename, 0
+        yield '.zero', [str(n)], filename, 0
+        pos = ofs + n
+    if length > pos:
+        yield '.data', [str(image[start + pos:start + length])], filename, 0
 
 
 # ----------------------------------------------------------------------
-#       main process
+#       assembler
 # ----------------------------------------------------------------------
 
-# parse command line arguments
-argparser = argparse.ArgumentParser(usage='%(prog)s [options] file...')
-argparser.add_argument('inputs', nargs='*', help='input files', metavar='file...')
-argparser.add_argument('-a', help='output as rs232c send test format', action='store_true')
-argparser.add_argument('-c', help='do not append file header', action='store_true')
-argparser.add_argument('-e', help='set entry point address', metavar='<integer>')
-argparser.add_argument('-f', help='append label to end of program', metavar='<label>')
-argparser.add_argument('-k', help='output as array of std_logic_vector format', action='store_true')
-argparser.add_argument('-l', help='set library file to <file>', metavar='<file>', action='append')
-argparser.add_argument('-o', help='set output file to <file>', metavar='<file>', default='a.out')
-argparser.add_argument('-O', help='set optimization level', metavar='<integer>', default=2, type=int)
-argparser.add_argument('-r', help='do not insert main label jump instruction', action='store_true')
-argparser.add_argument('-s', help='output preprocessed assembly', action='store_true')
-argparser.add_argument('-start', help='same as -t (deprecated)', metavar='<label>', dest='t')
-argparser.add_argument('-t', help='start execution from <label>', metavar='<label>')
-argparser.add_argument('-v', help='output more detailed assembly than -s', action='store_true')
-argparser.add_argument('-Wno-unused-label', help='disable unused label warning', action='store_true')
-argparser.add_argument('-Wr29', help='enable use of r29 warning', action='store_true')
-args = argparser.parse_args()
-if args.inputs == []:
-    argparser.print_help(sys.stderr)
-    sys.exit(1)
-if args.e:
-    success, entry_point = parse_int(args.e)
-    if not success:
-        argparser.print_usage(sys.stderr)
-        fatal('argument -e: expected integer: ' + args.e)
-    if entry_point & 3 != 0:
-        argparser.print_usage(sys.stderr)
-        fatal('argument -e: entry address must be a multiple of 4')
-    if entry_point < 0:
-        argparser.print_usage(sys.stderr)
-        fatal('argument -e: entry address must be zero or positive')
-if args.l:
-    library = map(os.path.relpath, args.l)
-    args.inputs = library + args.inputs
-if args.t:
-    start_label = args.t
-
-# 0. preprocess
-lines0 = []
-for filename in args.inputs:
-    filename = os.path.relpath(filename)
-    if not os.path.isfile(filename):
-        fatal('file does not exist: ' + filename)
-    with open(filename, 'r') as f:
-        srcs[filename] = {}
-        for pos, line in enumerate(f):
-            line = line.strip()
-            if line:
-                srcs[filename][pos + 1] = line
-                lines0.append((line, filename, pos + 1))
-if lines0:
-    lines0.append(('.align 4', lines0[-1][1], lines0[-1][2]))
-if args.f:
-    lines0.append(('.global ' + args.f, '_end', 0))
-    lines0.append((args.f + ':', '_end', 0))
-
-# 1. macro expansion
-lines1 = []
-if not args.r:
-    lines1 = [('mov', ['r29', start_label], '', 0), ('jr', ['r29', 'r29'], '', 0)]
-for line, filename, pos in lines0:
-    lines = expand_macro(line)
-    lines1.extend(map(lambda (x, y): (x, y, filename, pos), lines))
-if args.Wr29:
-    f = p = ''
-    for mnemonic, operands, filename, pos in lines1:
-        if 'r29' in operands and not (f == filename and p == pos):
-            f, p = filename, pos
-            warning('r29 is used', True)
-
-# 2. label resolution (by 2-pass algorithm)
-init_label_first(lines1)
-while args.O > 0 and optimize(lines1):
-    args.O -= 1
-    init_label(lines1)
-lines2 = resolve_label(lines1)
-for mnemonic, operands, filename, pos in lines1:
-    if mnemonic == '.global':
-        check_global(operands[0])
-    if mnemonic[-1] == ':' and not args.Wno_unused_label:
-        warn_unused_label(mnemonic[:-1])
-
-# 3. assemble
-if args.s or args.v:
-    with open(args.o + '.s', 'w') as f:
-        addr = entry_point
+def split_runs(lines):
+    # pre-encoded runs from object files are listed word by word
+    for mnemonic, operands, filename, pos in lines:
+        if mnemonic in ['.code', '.data']:
+            for i in range(0, len(operands[0]), 4):
+                yield mnemonic, [operands[0][i:i+4]], filename, pos
+        else:
+            yield mnemonic, operands, filename, pos
+
+class Lines(object):
+    # Compact store for the expanded lines of one source file, kept between
+    # passes: mnemonics as ids into a per-file table (labels are mnemonics
+    # too, so a global table would only grow), the parsed operands shared
+    # through parse_operand() in one flat list, and positions and operand
+    # ends in arrays.  Iterating yields the usual (mnemonic, operands,
+    # filename, pos) tuples.
+    __slots__ = ['filename', 'names', 'ops', 'pos', 'ends', 'operands']
+
+    def __init__(self, filename, lines=()):
+        self.filename = filename
+        self.names = []
+        self.ops = array.array('i')
+        self.pos = array.array('i')
+        self.ends = array.array('I')
+        self.operands = []
+        ids = {}
+        for mnemonic, operands, _, pos in lines:
+            if mnemonic not in ids:
+                ids[mnemonic] = len(self.names)
+                self.names.append(intern(mnemonic))
+            self.ops.append(ids[mnemonic])
+            self.pos.append(pos)
+            self.operands.extend(operands)
+            self.ends.append(len(self.operands))
+
+    def __len__(self):
+        return len(self.ops)
+
+    def __iter__(self):
+        filename, names, operands = self.filename, self.names, self.operands
+        start = 0
+        for op, pos, end in itertools.izip(self.ops, self.pos, self.ends):
+            yield names[op], operands[start:end], filename, pos
+            start = end
+
+    def tostring(self):
+        # operands are stored as text and parsed again by fromstring()
+        return marshal.dumps((self.names, self.ops.tostring(), self.pos.tostring(),
+                              self.ends.tostring(), map(str, self.operands)))
+
+    def fromstring(self, data):
+        self.names, ops, pos, ends, operands = marshal.loads(data)
+        self.ops.fromstring(ops)
+        self.pos.fromstring(pos)
+        self.ends.fromstring(ends)
+        if not len(self.ops) == len(self.pos) == len(self.ends) or \
+           len(self.ends) and self.ends[-1] != len(operands):
+            raise ValueError('inconsistent columns')
+        start = 0
+        for op, end in itertools.izip(self.ops, self.ends):
+            self.operands.extend(parse_operands(self.names[op], operands[start:end]))
+            start = end
+
+def expand_job((filename, cache_dir, cache_limit)):
+    # worker side of Assembler.load_parallel()
+    asm = Assembler(cache_dir=cache_dir, cache_limit=cache_limit)
+    try:
+        ret = asm.guard(lambda: map(asm.retain, asm.read(filename)))
+    except AsmError as e:
+        return None, (e.msg, e.is_fatal, e.filename, e.pos, e.line)
+    return [(name, src, last, lines if isinstance(lines, list) else lines.tostring())
+            for name, src, last, lines in ret], None
+
+def deferred_error(e):
+    raise e
+    yield
+
+class Program(object):
+    def __init__(self, asm, image):
+        self.asm = asm
+        self.entry_point = asm.entry_point
+        self.image = image
+        self.zeros = asm.zeros
+        self.labels, self.rev_labels = asm.symbol_table()
+        self.warnings = asm.warnings
+
+    @property
+    def lines(self):
+        # unless kept while encoding, the resolved lines are streamed again
+        if self.asm.resolved is not None:
+            return self.asm.resolved
+        return self.asm.resolve_label(self.asm.expanded_lines())
+
+    def show_label(self, i):
+        if i in self.rev_labels:
+            return format(', '.join(self.rev_labels[i]))
+        return ''
+
+    def listing(self, f, verbose=False):
+        # words are taken from the image, so nothing is encoded twice
+        image = self.image
+        rev_labels = self.rev_labels
+        source_line = self.asm.source_line
+        out = []
+        addr = self.entry_point
+        ofs = 0
         prev_pos = -1
         prev_file = ''
-        for mnemonic, operands, filename, pos in lines2:
+        for mnemonic, operands, filename, pos in split_runs(self.lines):
             if prev_file != filename:
-                print >> f, '\n# file: ' + filename
+                out.append('\n# file: ' + filename)
                 prev_file = filename
-            s = '{:#08x}  {:7} {}'.format(addr, mnemonic, ', '.join(operands))
-            l = show_label(addr)
-            if args.v:
-                b = code(mnemonic, operands).ljust(4, '\0')[0:4]
-                comment = '# [{:08x}]  '.format(struct.unpack('<I', b)[0])
+            if mnemonic in encode_table:
+                s = '%#08x  %-7s %s' % (addr, mnemonic, ', '.join(map(operand_str, operands)))
+                size = 4
+            elif mnemonic in ['.code', '.data']:
+                s = '%#08x  %-7s %s' % (addr, mnemonic, operands[0].encode('hex'))
+                size = len(operands[0])
+            elif mnemonic == '.int':
+                # values which fit in a byte are shown in decimal
+                s = '%#08x  %-7s %s' % (addr, mnemonic, ', '.join(
+                    str(x) if check_int_range(x, 8) else operand_str(x) for x in operands))
+                size = 4 * len(operands)
+            else:
+                s = '%#08x  %-7s %s' % (addr, mnemonic, ', '.join(operands))
+                size = calc_ofs(mnemonic, operands)
+            l = ', '.join(rev_labels[addr]) if addr in rev_labels else ''
+            if verbose:
+                if size >= 4:
+                    comment = '# [%08x]  ' % word.unpack_from(image, ofs)
+                else:
+                    comment = '# [%08x]  ' % word.unpack(str(image[ofs:ofs + size]).ljust(4, '\0'))
                 if l:
                     comment += '(' + l + ')  '
                 if prev_pos != pos and filename:
-                    comment += srcs[filename][pos]
+                    comment += source_line(filename, pos)
                     prev_pos = pos
             else:
                 comment = '# ' + l if l else ''
-            print >> f, '{:39} {}'.format(s, comment).rstrip()
+            out.append((s.ljust(39) + ' ' + comment).rstrip())
+            if len(out) >= 0x1000:
+                f.write('\n'.join(out) + '\n')
+                del out[:]
+            addr += size
+            ofs += size
+        if out:
+            f.write('\n'.join(out) + '\n')
+
+class Assembler(object):
+    def __init__(self, entry_point=0x2000, start_label='main', opt_level=2,
+                 start_jump=True, end_label=None, warn_unused_label=True, warn_r29=False,
+                 cache=None, stream=False, cache_dir=None, cache_limit=256 << 20,
+                 cache_sources=False, cache_encoded=False, jobs=1, keep_lines=False,
+                 timer=None):
+        self.entry_point = entry_point
+        self.start_label = start_label
+        self.opt_level = opt_level
+        self.start_jump = start_jump
+        self.end_label = end_label
+        self.warn_unused_label = warn_unused_label
+        self.warn_r29 = warn_r29
+        self.cache = {} if cache is None else cache
+        self.stream = stream
+        self.cache_dir = cache_dir
+        self.cache_limit = cache_limit
+        self.cache_sources = cache_sources
+        self.cache_encoded = cache_encoded
+        self.jobs = jobs
+        self.keep_lines = keep_lines
+        self.timer = timer
+        # files included by .incbin in the last build, for -MD and --watch
+        self.binaries = []
+        # with cache_encoded, what relayout() and reused_lines() keep from the
+        # last build
+        self.start_lines = None
+        self.layout_state = None
+        self.encode_state = None
+        self.refs = None
+        self.clear_counters()
+
+    def assemble(self, inputs, library=()):
+        # each input is a file path (source or object file) or a (filename, text) pair
+        return self.guard(self.run, inputs, library)
+
+    def compile(self, inputs):
+        # same as assemble(), but stops before layout; see write_object()
+        return self.guard(self.run_compile, inputs)
+
+    def guard(self, func, *args):
+        self.srcs = {}
+        self.texts = {}
+        self.labels = {}
+        self.expr_values = {}
+        self.library = []
+        self.warnings = []
+        self.binaries = []
+        self.refs = None
+        self.filename = ''
+        self.pos = 0
+        self.clear_counters()
+        linecache.clearcache()
+        try:
+            return func(*args)
+        except AsmError as e:
+            if not e.is_fatal and e.filename is None:
+                e.filename, e.pos = self.filename, self.pos
+                e.line = self.source_line(self.filename, self.pos)
+            raise
+
+    def clear_counters(self):
+        # hot-path counters for --time-report
+        self.expr_evals = 0
+        self.label_lookups = 0
+        self.relax_passes = []
+        self.macro_counts = {}
+        self.image_size = 0
+
+    def warning(self, msg, show_line=False):
+        line = self.source_line(self.filename, self.pos) if show_line else None
+        self.warnings.append((self.filename, self.pos, msg, line))
+
+    def source_line(self, filename, pos):
+        # source files are not kept in memory; a line is read back from disk
+        # when a diagnostic or the listing needs it
+        if filename in self.srcs:
+            return self.srcs[filename].get(pos)
+        if filename in self.texts:
+            text = self.texts[filename]
+            return text[pos - 1].strip() if 0 < pos <= len(text) else None
+        return linecache.getline(filename, pos).strip() or None
+
+    def load(self, source, is_library=False):
+        # returns a list of (filename, src, last, lines), one per source file;
+        # src holds the source lines of an object file (None otherwise) and
+        # last the position of the last non-blank line.  The lines of a plain
+        # source file are expanded while they are iterated, and last is None
+        # until then (see expand_source())
+        if isinstance(source, tuple):
+            filename, text = source
+            self.texts[filename] = text = text.split('\n')
+            return [(filename, None, None, self.expand_source(filename, text))]
+        filename = os.path.relpath(source)
+        key, stamp = self.cache_stamp(filename, is_library)
+        if key in self.cache and self.cache[key][0] == stamp:
+            return self.cache[key][1]
+        ret = self.read(filename)
+        if key:
+            ret = self.keep(key, stamp, ret)
+        return ret
+
+    def cache_stamp(self, filename, is_library):
+        # library files (and with cache_sources, all files) are kept
+        # expanded while they are unchanged on disk; with cache_encoded
+        # they are kept pre-encoded like object files, so that only label
+        # references are resolved and encoded again
+        if not (is_library or self.cache_sources):
+            return None, None
+        st = os.stat(filename)
+        return os.path.abspath(filename), (filename, st.st_mtime, st.st_size)
+
+    def keep(self, key, stamp, ret):
+        ret = map(self.retain, ret)
+        if self.cache_encoded:
+            ret = [(name, src, last, self.pre_encode(lines) if src is None else lines)
+                   for name, src, last, lines in ret]
+        self.cache[key] = stamp, ret
+        return ret
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            is_object = f.read(len(obj_magic)) == obj_magic
+            if is_object:
+                files = read_object(filename, obj_magic + f.read())
+        if is_object:
+            return [(name, src, max(src) if src else None, parse_lines(lines)) for name, src, lines in files]
+        if self.cache_dir:
+            return [self.load_cached(filename)]
+        return [(filename, None, None, self.expand_source(filename, read_lines(filename)))]
+
+    def load_parallel(self):
+        # -j: read and expand the input files in worker processes; the
+        # results are taken up in command-line order by expanded_lines(),
+        # and an error is raised only when the stream reaches its file
+        tasks = []
+        for k, (source, is_library) in enumerate(self.sources):
+            if isinstance(source, tuple):
+                continue
+            filename = os.path.relpath(source)
+            key, stamp = self.cache_stamp(filename, is_library)
+            if key not in self.cache or self.cache[key][0] != stamp:
+                tasks.append((k, filename, key, stamp))
+        if len(tasks) < 2:
+            return
+        import multiprocessing
+        pool = multiprocessing.Pool(min(self.jobs, len(tasks)), init_worker)
+        try:
+            results = pool.map(expand_job, [(path, self.cache_dir, self.cache_limit)
+                                            for _, path, _, _ in tasks])
+        finally:
+            pool.close()
+            pool.join()
+        for (k, filename, key, stamp), (ret, err) in zip(tasks, results):
+            if err:
+                e = AsmError(*err[:2])
+                e.filename, e.pos, e.line = err[2:]
+                self.retained[k] = [(filename, None, None, deferred_error(e))]
+                continue
+            for i, (name, src, last, lines) in enumerate(ret):
+                if not isinstance(lines, list):
+                    data, lines = lines, Lines(name)
+                    lines.fromstring(data)
+                    ret[i] = name, src, last, lines
+            self.retained[k] = self.keep(key, stamp, ret) if key else ret
+
+    def load_cached(self, filename):
+        # Expansions are kept in cache_dir under a hash of the file contents
+        # (and of this assembler), so an entry is never used for a changed
+        # file.  On a miss the hash is taken again while expanding, so what
+        # is stored matches what was read even if the file changes meanwhile.
+        digest = hashlib.sha1(cache_salt())
+        hash_file(digest, filename)
+        entry = read_cache(self.cache_dir, digest.hexdigest() + '.exp')
+        if entry:
+            try:
+                last, data = entry
+                lines = Lines(filename)
+                lines.fromstring(data)
+                return filename, None, last, lines
+            except (ValueError, EOFError, TypeError):
+                pass
+        digest = hashlib.sha1(cache_salt())
+        ret = self.retain((filename, None, None, self.expand_source(filename, read_lines(filename, digest))))
+        write_cache(self.cache_dir, digest.hexdigest() + '.exp',
+                    (ret[2], ret[3].tostring()), self.cache_limit)
+        return ret
+
+    def retain(self, (filename, src, last, lines)):
+        if not isinstance(lines, (list, Lines)):
+            self.file_last = None
+            with (self.timer or TimeReport(False)).phase('expand'):
+                lines = Lines(filename, lines)
+            last = self.file_last
+        return filename, src, last, lines
+
+    def expand_source(self, filename, text):
+        # unless streamed, the lines are expanded all at once in retain()
+        if not self.timer:
+            return self.expand_text(filename, text, None)
+        lines = self.expand_text(filename, text, self.macro_counts)
+        return self.timer.iterate('expand', lines) if self.stream else lines
+
+    def expand_text(self, filename, text, counts):
+        # counts, if given, collects the source lines per macro mnemonic
+        for pos, line in enumerate(text, 1):
+            line = line.strip()
+            if line:
+                self.filename, self.pos = filename, pos
+                self.file_last = pos
+                expansion = expansion_cache.expand(line)
+                if counts is not None and expansion:
+                    mnemonic = line.split(None, 1)[0]
+                    if len(expansion) > 1 or expansion[0][0] != mnemonic:
+                        counts[mnemonic] = counts.get(mnemonic, 0) + 1
+                for x, y in expansion:
+                    yield x, y, filename, pos
+
+    def expanded_lines(self):
+        # 0. preprocess and 1. macro expansion, streamed over all inputs.
+        # Unless self.stream is set, the expansion of each input is kept for
+        # the following passes; otherwise every pass reads the sources again
+        for _, _, lines in self.segments():
+            for line in lines:
+                yield line
+
+    def segments(self):
+        # the stream of expanded_lines() as (tag, filename, lines), one per
+        # source file plus the start jump and the tail.  The tag of a file
+        # is its kept lines, which stay the same object while the file is
+        # unchanged; the tail has none
+        if self.start_jump:
+            if self.start_lines is None:
+                self.start_lines = [('mov', parse_operands('mov', ['r29', self.start_label]), '', 0),
+                                    ('jr', parse_operands('jr', ['r29', 'r29']), '', 0)]
+            yield self.start_lines, '', self.start_lines
+        last = None
+        for k, (source, is_library) in enumerate(self.sources):
+            if k in self.retained:
+                files = self.retained[k]
+            else:
+                files = self.load(source, is_library)
+                if not self.stream:
+                    files = self.retained[k] = map(self.retain, files)
+            for filename, src, self.file_last, lines in files:
+                if is_library and filename not in self.library:
+                    self.library.append(filename)
+                if src is not None:
+                    self.srcs[filename] = src
+                yield (lines if isinstance(lines, (list, Lines)) else None), filename, lines
+                if self.file_last:
+                    last = filename, self.file_last
+        tail = []
+        if last:
+            tail.append(('.align 4',) + last)
+        if self.end_label:
+            tail.append(('.global ' + self.end_label, '_end', 0))
+            tail.append((self.end_label + ':', '_end', 0))
+        yield None, '_end', [(x, parse_operands(x, y), filename, pos)
+                             for line, filename, pos in tail for x, y in expand_macro(line)]
+
+    def check_r29(self, lines):
+        f = p = ''
+        for line in lines:
+            mnemonic, operands, self.filename, self.pos = line
+            if mnemonic not in ['.code', '.data'] and 'r29' in map(str, operands) and \
+               not (f == self.filename and p == self.pos):
+                f, p = self.filename, self.pos
+                self.warning('r29 is used', True)
+            yield line
+
+    def run_compile(self, inputs):
+        for source in inputs:
+            if not isinstance(source, tuple) and not os.path.isfile(source):
+                fatal('file does not exist: ' + os.path.relpath(source))
+        files = []
+        for source in inputs:
+            for filename, src, last, lines in self.load(source):
+                if src is not None:
+                    self.srcs[filename] = src
+                if self.warn_r29:
+                    lines = self.check_r29(lines)
+                lines = self.pre_encode(lines)
+                files.append((filename, dict((pos, self.source_line(filename, pos)) for _, _, _, pos in lines),
+                              operand_texts(lines)))
+        return files
+
+    def pre_encode(self, lines):
+        # encode everything that does not depend on the final layout; what
+        # is left (labels, .set, .align, .space and anything referring to a
+        # label) is kept as relocation records for the link step
+        ret = []
+        for mnemonic, operands, self.filename, self.pos in lines:
+            if mnemonic[-1] == ':' or mnemonic in reloc_mnemonics or \
+               mnemonic in branch_mnemonics and is_label(operands[-1]) or \
+               mnemonic == '.int' and not all(parse_int(operand)[0] for operand in operands):
+                ret.append((mnemonic, operands, self.filename, self.pos))
+                continue
+            kind = '.data' if mnemonic in ['.byte', '.short', '.int'] else '.code'
+            byterepr = code(mnemonic, operands)
+            if ret and ret[-1][0] == kind:
+                ret[-1][1][0] += byterepr
+            else:
+                ret.append((kind, [byterepr], self.filename, self.pos))
+        return ret
+
+    def run(self, inputs, library):
+        self.sources = [(source, True) for source in library] + [(source, False) for source in inputs]
+        for source, is_library in self.sources:
+            if not isinstance(source, tuple) and not os.path.isfile(source):
+                fatal('file does not exist: ' + os.path.relpath(source))
+        self.retained = {}
+        timer = self.timer or TimeReport(False)
+        if self.jobs > 1:
+            with timer.phase('load'):
+                self.load_parallel()
+
+        # 0, 1. preprocess and macro expansion, streamed into
+        # 2. label resolution (with relaxation unless -O0), which keeps
+        # only the skeleton of the program
+        lines = self.expanded_lines()
+        if self.warn_r29:
+            lines = self.check_r29(lines)
+        with timer.phase('layout'):
+            skeleton = self.relayout() if self.cache_encoded else self.init_label_first(lines)
+        items = [i for i, line in enumerate(skeleton) if line[0] in shrink_table]
+        if self.opt_level > 0:
+            with timer.phase('relax'):
+                self.relax(skeleton)
+        self.forms = [skeleton[i][0] for i in items]
+        size = self.image_size = self.size - self.entry_point
+        if size > 0x400000:
+            fatal('program size exceeds 4MB limit ({:,} bytes)'.format(size))
+
+        # 3. assemble, streaming the sources once more
+        with timer.phase('encode'):
+            if self.cache_encoded:
+                lines, forms = self.reused_lines(items)
+            else:
+                lines, forms = self.expanded_lines(), self.forms
+            image = self.encode(timer.iterate('resolve', self.resolve_label(lines, forms)), size)
+            if self.cache_encoded:
+                self.keep_segments(image)
+        with timer.phase('check'):
+            for mnemonic, operands, self.filename, self.pos in skeleton:
+                if mnemonic == '.global':
+                    self.check_global(operands[0])
+                if mnemonic[-1] == ':' and self.warn_unused_label:
+                    self.check_unused_label(mnemonic[:-1])
+        return Program(copy.copy(self), image)
+
+    def encode(self, lines, size):
+        image = bytearray(size)
+        self.zeros = []
+        # with keep_lines the listing reads the resolved lines from here
+        # instead of resolving them once more
+        resolved = self.resolved = [] if self.keep_lines else None
+        i = 0
+        for line in lines:
+            mnemonic, operands, self.filename, self.pos = line
+            if resolved is not None:
+                resolved.append(line)
+            if mnemonic in encode_table:
+                word.pack_into(image, i, encode_table[mnemonic](operands))
+                i += 4
+            elif mnemonic == '.zero':
+                # left out of the image file; see zero_fill_image()
+                self.zeros.append((i, int(operands[0], 0)))
+                i += self.zeros[-1][1]
+            elif mnemonic == '.space' and operands[1] == '0':
+                # the image starts out zero-filled
+                i += max(int(operands[0], 0), 0)
+            else:
+                byterepr = code(mnemonic, operands)
+                image[i:i + len(byterepr)] = byterepr
+                i += len(byterepr)
+        return image
+
+    # Each (label, declaring file) pair owns a slot; addresses, .global flags
+    # and "used" bits are kept per slot.  Once all declarations are known,
+    # label_addr() memoizes which slot a (referencing file, label) resolves to.
+
+    def label_slot(self, label):
+        dic = self.labels.setdefault(label, {})
+        if self.filename not in dic:
+            dic[self.filename] = len(self.slots)
+            self.slots.append((label, self.filename))
+            self.addrs.append(-1)
+            self.globals.append(0)
+            self.used.append(0)
+        return dic[self.filename]
+
+    def add_label(self, label, i):
+        if label in regs:
+            error('\'{}\' is register name'.format(label))
+        if parse_int(label)[0]:
+            error('\'{}\' can be parsed as integer'.format(label))
+        if re.search(r'[^\w.$!?]', label):
+            c = re.search(r'[^\w.$!?]', label).group()
+            error('label name cannot contain \'{}\' character'.format(c))
+        slot = self.label_slot(label)
+        if self.addrs[slot] >= 0:
+            error('duplicate declaration of label \'{}\''.format(label))
+        self.addrs[slot] = i
+        self.decls.append(slot)
+
+    def add_global(self, label):
+        self.globals[self.label_slot(label)] = 1
+
+    def label_addr(self, label):
+        self.label_lookups += 1
+        key = self.filename, label
+        if key in self.index:
+            slot = self.index[key]
+        else:
+            slot = self.resolve(label)
+            if self.index_ready:
+                self.index[key] = slot
+        self.used[slot] = 1
+        if self.refs is not None:
+            self.refs[key] = slot
+        return self.addrs[slot]
+
+    def resolve(self, label):
+        dic = self.labels.get(label, {})
+        if self.filename in dic:
+            decl = [self.filename]
+        else:
+            decl = filter(lambda x: self.globals[dic[x]], dic)
+        if len(decl) == 0:
+            if label == self.start_label:
+                fatal('global label \'{}\' is required'.format(label))
+            else:
+                error('label \'{}\' is not declared'.format(label))
+        if len(decl) > 1 and not set(decl) <= set(self.library):
+            decl = list(set(decl) - set(self.library))
+        if len(decl) > 1:
+            msg = 'label \'{}\' is declared in multiple files ({})'.format(label, ', '.join(sorted(decl)))
+            if label == self.start_label:
+                fatal(msg)
+            else:
+                error(msg)
+        return dic[decl[0]]
+
+    def symbol_table(self):
+        labels = {}
+        for slot, (label, filename) in enumerate(self.slots):
+            decl = [self.addrs[slot], bool(self.globals[slot]), bool(self.used[slot])]
+            labels.setdefault(label, {})[filename] = decl
+        rev_labels = {}
+        for slot in self.decls:
+            rev_labels.setdefault(self.addrs[slot], []).append(self.slots[slot][0])
+        return labels, rev_labels
+
+    def eval_expr(self, expr):
+        self.expr_evals += 1
+        if expr not in expr_cache:
+            if len(expr_cache) >= 0x10000:
+                expr_cache.clear()
+            expr_cache[expr] = compile_expr(expr)
+        code, names = expr_cache[expr]
+        addrs = [self.label_addr(name) for name in names]
+        # skip evaluation if none of the referenced labels has moved
+        key = expr, self.filename
+        if key in self.expr_values and self.expr_values[key][0] == addrs:
+            return self.expr_values[key][1]
+        try:
+            res = eval(code, {'_': addrs, '__builtins__': {}})
+        except Exception:
+            error('eval error: ' + substitute_expr(expr, addrs))
+        if not isinstance(res, int):
+            error('expression type must be int')
+        self.expr_values[key] = addrs, res
+        return res
+
+    def init_label_first(self, lines):
+        # lays out the stream and returns its skeleton: the lines layout and
+        # the label checks need, with the runs of lines in between folded
+        # into ('.skip', [size]) entries
+        self.clear_labels()
+        skeleton = []
+        self.size = self.lay_out(lines, skeleton, self.entry_point)
+        self.index_ready = True
+        return skeleton
+
+    def clear_labels(self):
+        self.labels = {}
+        self.slots = []
+        self.addrs = []
+        self.globals = bytearray()
+        self.used = bytearray()
+        self.decls = []
+        self.index = {}
+        self.index_ready = False
+
+    def lay_out(self, lines, skeleton, addr):
+        # appends the skeleton of lines starting at addr; returns the address
+        # after them
+        skip = addr
+        for line in lines:
+            mnemonic, operands, self.filename, self.pos = line
+            keep = mnemonic[-1] == ':' or mnemonic in ['.align', '.global', '.set'] or \
+                   mnemonic in shrink_table
+            if keep:
+                if addr != skip:
+                    skeleton.append(('.skip', [addr - skip], '', 0))
+                skeleton.append(line)
+            if mnemonic[-1] == ':':
+                if len(operands) > 0:
+                    error('label declaration must be followed by new line')
+                self.add_label(mnemonic[:-1], addr)
+            elif mnemonic == '.align':
+                check_operands_n(operands, 1)
+                success, imm = parse_int(operands[0])
+                if not success:
+                    error('expected integer literal: ' + operands[0])
+                if imm < 4 or (imm & (imm - 1)) > 0:
+                    error('alignment must be a power of 2 which is not less than 4')
+                addr += ((addr + imm - 1) & ~(imm - 1)) - addr
+            elif mnemonic == '.byte':
+                addr += len(operands)
+            elif mnemonic == '.code':
+                if addr & 3:
+                    error('instruction must be aligned on 4-byte boundaries')
+                addr += len(operands[0])
+            elif mnemonic == '.data':
+                addr += len(operands[0])
+            elif mnemonic == '.zero':
+                addr += int(operands[0], 0)
+            elif mnemonic == '.incbin':
+                path = eval_string(operands[0])
+                if path not in self.binaries:
+                    self.binaries.append(path)
+                addr += calc_ofs(mnemonic, operands)
+            elif mnemonic == '.global':
+                check_operands_n(operands, 1)
+                self.add_global(operands[0])
+            elif mnemonic == '.int':
+                addr += 4 * len(operands)
+            elif mnemonic == '.set':
+                check_operands_n(operands, 2)
+                self.add_label(operands[0], self.eval_expr(operands[1]))
+            elif mnemonic == '.short':
+                addr += 2 * len(operands)
+            elif mnemonic == '.space':
+                check_operands_n(operands, 2)
+                success, imm = parse_int(operands[0])
+                if not success:
+                    error('expected integer literal: ' + operands[0])
+                addr += imm
+            else:
+                if addr & 3:
+                    error('instruction must be aligned on 4-byte boundaries')
+                addr += ofs_table.get(mnemonic, 4)
+            if keep:
+                skip = addr
+        if addr != skip:
+            skeleton.append(('.skip', [addr - skip], '', 0))
+        return addr
+
+    # With cache_encoded (--watch), what was done per segment (see
+    # segments()) is kept for the next build.  Layout is taken up at the
+    # first segment which is not the same as in the last build; the skeleton
+    # and label tables of the segments before it are restored as they were
+    # before relaxation.  relax() still runs over the whole skeleton: forms
+    # chosen before the change depend on addresses after it, and starting
+    # from the old ones could keep a longer form than a full build would.
+    # A segment whose address, length, forms and label addresses are all
+    # unchanged is copied from the last image instead of being resolved
+    # and encoded again.
+
+    def relayout(self, reuse=True):
+        # init_label_first() by segment.  The checkpoint taken before each
+        # segment is (tag, skeleton length, slots, decls, binaries, address,
+        # slots marked used by the segment, stamps of its binaries)
+        state = self.layout_state if reuse else None
+        checkpoints = self.checkpoints = []
+        names = set()
+        reused = False
+        skeleton = None
+        for i, (tag, filename, lines) in enumerate(self.segments()):
+            if names is not None and filename in names:
+                # the labels of a file are spread over segments, so those of
+                # one segment may be changed by a later one
+                if reused:
+                    return self.relayout(False)
+                names = None
+            elif names is not None:
+                names.add(filename)
+            if skeleton is None:
+                if state and i < len(state[0]) and same_segment(state[0][i], tag):
+                    checkpoints.append(state[0][i])
+                    reused = True
+                    continue
+                skeleton, addr = self.restore_layout(state, i)
+            checkpoint = (tag, len(skeleton), len(self.slots), len(self.decls), len(self.binaries), addr)
+            self.refs = {}
+            addr = self.lay_out(lines, skeleton, addr)
+            marks, self.refs = self.refs.values(), None
+            checkpoints.append(checkpoint + (marks, file_stamps(self.binaries[checkpoint[4]:])))
+        self.size = addr
+        self.index_ready = True
+        self.layout_state = None
+        if names is not None:
+            self.layout_state = (checkpoints, list(skeleton), self.slots, list(self.addrs), self.globals,
+                                 self.decls, self.binaries)
+        return skeleton
+
+    def restore_layout(self, state, n):
+        # label tables as they were after the first n segments of the last
+        # layout; returns the skeleton and address at that point
+        if not state or n == 0 or n >= len(state[0]):
+            self.clear_labels()
+            return [], self.entry_point
+        checkpoints, skeleton, slots, addrs, flags, decls, binaries = state
+        _, n_skeleton, n_slots, n_decls, n_binaries, addr = checkpoints[n][:6]
+        self.slots = slots[:n_slots]
+        self.addrs = addrs[:n_slots]
+        self.globals = flags[:n_slots]
+        self.used = bytearray(n_slots)
+        for checkpoint in checkpoints[:n]:
+            for slot in checkpoint[6]:
+                self.used[slot] = 1
+        self.decls = decls[:n_decls]
+        self.binaries = binaries[:n_binaries]
+        self.labels = {}
+        for slot, (label, filename) in enumerate(self.slots):
+            self.labels.setdefault(label, {})[filename] = slot
+        self.index = {}
+        self.index_ready = False
+        return skeleton[:n_skeleton], addr
+
+    def reused_lines(self, items):
+        # the stream for resolve_label() and the forms of its relaxable
+        # items, with the segments which are as in the last image copied
+        # from there.  The record kept for each segment is (tag, address,
+        # length, forms, labels looked up with their addresses, .zero
+        # areas, stamps of its binaries)
+        image, records = self.encode_state or (None, [])
+        checkpoints = self.checkpoints
+        starts = [self.line_addrs[c[1]] if self.opt_level > 0 else c[5] for c in checkpoints] + [self.size]
+        bounds = [bisect.bisect_left(items, c[1]) for c in checkpoints] + [len(items)]
+        self.records = []
+        self.fresh = []
+        parts = []
+        forms = []
+        for i, (tag, filename, lines) in enumerate(self.segments()):
+            record = [tag, starts[i], starts[i + 1] - starts[i], self.forms[bounds[i]:bounds[i + 1]], {}, None,
+                      checkpoints[i][7]]
+            old = records[i] if i < len(records) else None
+            if tag is not None and old and old[0] is tag and old[1:4] == record[1:4] and \
+               old[6] == record[6] and self.same_refs(old[4]):
+                self.records.append(old)
+                parts.append(copied_lines(image, old[1] - self.entry_point, old[2], old[5], filename))
+            else:
+                self.records.append(record)
+                self.fresh.append(record)
+                parts.append(self.logged_lines(lines, record))
+                forms.extend(record[3])
+        return itertools.chain.from_iterable(parts), forms
+
+    def same_refs(self, refs):
+        # whether the labels looked up by a segment still have the same
+        # addresses; they are marked used as resolve_label() would
+        try:
+            for (self.filename, label), addr in refs.iteritems():
+                if self.label_addr(label) != addr:
+                    return False
+        except AsmError:
+            return False
+        return True
+
+    def logged_lines(self, lines, record):
+        # lines are taken one at a time, after the previous one has been
+        # resolved and encoded, so what is done in between is theirs
+        self.refs = record[4]
+        first = len(self.zeros)
+        for line in lines:
+            yield line
+        self.refs = None
+        record[5] = self.zeros[first:]
+
+    def keep_segments(self, image):
+        # the segments encoded this time get the addresses of their labels,
+        # and their .zero areas relative to their start
+        for record in self.fresh:
+            ofs = record[1] - self.entry_point
+            record[4] = dict((key, self.addrs[slot]) for key, slot in record[4].iteritems())
+            record[5] = [(i - ofs, n) for i, n in record[5]]
+        self.encode_state = image, self.records
+
+    def relax(self, lines):
+        # Span-dependent instruction relaxation.  Every mov/ld2/st2/ldb2/stb2
+        # and call starts in its short form and is only ever grown while it
+        # does not fit, so the layout converges to a fixed point with the
+        # smallest code.  After each round of growth the addresses are
+        # recomputed from the first grown line onward, and only the items
+        # whose operands lie at or after that line are checked again.
+        items = []
+        for i, (mnemonic, operands, filename, pos) in enumerate(lines):
+            if mnemonic in shrink_table:
+                lines[i] = (shrink_table[mnemonic], operands, filename, pos)
+                items.append(i)
+        self.sizes = [operands[0] if mnemonic == '.skip' else calc_ofs(mnemonic, operands)
+                      for mnemonic, operands, _, _ in lines]
+        self.aligns = {}
+        self.label_lines = []
+        self.set_lines = []
+        decls = iter(self.decls)
+        for i, (mnemonic, operands, _, _) in enumerate(lines):
+            if mnemonic[-1] == ':':
+                self.label_lines.append((i, next(decls)))
+            elif mnemonic == '.set':
+                self.set_lines.append((i, next(decls)))
+            elif mnemonic == '.align':
+                self.aligns[i] = int(operands[0], 0)
+        self.line_addrs = [0] * (len(lines) + 1)
+        self.line_addrs[0] = self.entry_point
+        self.place(lines, 0)
+
+        decl_lines = dict((slot, i) for i, slot in self.label_lines)
+        decl_lines.update((slot, len(lines)) for i, slot in self.set_lines)
+        reach = {}
+        for i in items:
+            reach[i] = self.reach(lines, i, decl_lines)
+        work = items
+        while work:
+            grown = [i for i in work if self.grow(lines, i)]
+            self.relax_passes.append(len(grown))
+            if not grown:
+                break
+            start = min(grown)
+            self.place(lines, start)
+            work = [i for i in items if lines[i][0] in grow_table and reach[i] >= start]
+
+    def place(self, lines, start):
+        # recompute line and label addresses from line 'start' onward
+        addr = self.line_addrs[start]
+        sizes, aligns, line_addrs = self.sizes, self.aligns, self.line_addrs
+        for i in xrange(start, len(lines)):
+            line_addrs[i] = addr
+            if i in aligns:
+                addr = (addr + aligns[i] - 1) & ~(aligns[i] - 1)
+            else:
+                addr += sizes[i]
+        line_addrs[len(lines)] = self.size = addr
+        for i, slot in self.label_lines[bisect.bisect_left(self.label_lines, (start, -1)):]:
+            self.addrs[slot] = line_addrs[i]
+        for i, slot in self.set_lines:
+            _, operands, self.filename, self.pos = lines[i]
+            self.addrs[slot] = self.eval_expr(operands[1])
+
+    def reach(self, lines, i, decl_lines):
+        # last line whose address the operand of relaxable item i depends on;
+        # .set labels may depend on any line
+        mnemonic, operands, self.filename, self.pos = lines[i]
+        if mnemonic == 'call6':
+            names = [operands[0]]
+        else:
+            self.eval_expr(operands[1])
+            names = expr_cache[operands[1]][1]
+        ret = i
+        for name in names:
+            self.label_addr(name)
+            ret = max(ret, decl_lines.get(self.index[self.filename, name], 0))
+        return ret
+
+    def grow(self, lines, i):
+        mnemonic, operands, self.filename, self.pos = lines[i]
+        if mnemonic == 'call6':
+            val = self.label_addr(operands[0])
+            if check_int_range(val - self.line_addrs[i] - 16, 18):
+                return False
+            mnemonic = 'call7' if check_int_range(val, 16) else 'call'
+        elif mnemonic == 'call7':
+            if check_int_range(self.label_addr(operands[0]), 16):
+                return False
+            mnemonic = 'call'
+        else:
+            bits = 18 if mnemonic in ['ld1', 'st1'] else 16
+            if check_int_range(self.eval_expr(operands[1]), bits):
+                return False
+            mnemonic = grow_table[mnemonic]
+        lines[i] = (mnemonic, operands, self.filename, self.pos)
+        self.sizes[i] = ofs_table[mnemonic]
+        return True
+
+    def resolve_label(self, lines, forms=None):
+        # the relaxable items take the forms chosen on the skeleton, in order
+        forms = iter(self.forms if forms is None else forms)
+        addr = self.entry_point
+        r0, r28, r29 = map(parse_operand, ['r0', 'r28', 'r29'])
+        for mnemonic, operands, self.filename, self.pos in lines:
+            filename, pos = self.filename, self.pos
+            if mnemonic[-1] == ':' or mnemonic in ['.global', '.set']:
+                continue
+            if mnemonic in shrink_table:
+                mnemonic = next(forms)
+            if mnemonic == 'mov1':
+                addr += 4
+                yield 'ldl', [operands[0], self.eval_expr(operands[1])], filename, pos
+                continue
+            if mnemonic == 'mov':
+                addr += 8
+                val = self.eval_expr(operands[1])
+                if not -0x80000000 <= val <= 0xffffffff:
+                    if not filename:
+                        fatal('address of start label is too large: ' + hex(val))
+                    else:
+                        error('expression value too large: ' + hex(val))
+                yield 'ldl', [operands[0], val & 0xffff], filename, pos
+                yield 'ldh', [operands[0], operands[0], val >> 16 & 0xffff], filename, pos
+                continue
+            if mnemonic in ['ld1', 'ldb1', 'st1', 'stb1']:
+                addr += 4
+                yield mnemonic[:-1], [operands[0], r0, self.eval_expr(operands[1])], filename, pos
+                continue
+            if mnemonic in ['ld2', 'ldb2', 'st2', 'stb2']:
+                addr += 8
+                val = self.eval_expr(operands[1])
+                if not -0x80000000 <= val <= 0xffffffff:
+                    error('expression value too large: ' + hex(val))
+                hi, lo = (val + 0x8000) >> 16 & 0xffff, ((val + 0x8000) & 0xffff) - 0x8000
+                yield 'ldh', [r29, r0, hi], filename, pos
+                yield mnemonic[:-1], [operands[0], r29, lo], filename, pos
+                continue
+            if mnemonic in ['call', 'call6', 'call7']:
+                addr += ofs_table[mnemonic]
+                val = self.label_addr(operands[0])
+                if not -0x80000000 <= val <= 0xffffffff:
+                    error('expression value too large: ' + hex(val))
+                if mnemonic == 'call6':
+                    mid = [('jl', [r28, val - addr + 8])]
+                else:
+                    if mnemonic == 'call7':
+                        mid = [('ldl', [r29, val])]
+                    else:
+                        mid = [('ldl', [r29, val & 0xffff]),
+                               ('ldh', [r29, r29, val >> 16 & 0xffff])]
+                    mid.append(('jr', [r28, r29]))
+                for x, y in call_pre + mid + call_post:
+                    yield x, y, filename, pos
+                continue
+            if mnemonic == '.align':
+                align = int(operands[0], 0)
+                padding = ((addr + align - 1) & ~(align - 1)) - addr
+                if padding:
+                    addr += padding
+                    yield '.space', [str(padding), '0'], filename, pos
+                continue
+            if mnemonic in branch_mnemonics:
+                check_operands_n(operands, 2, 3)
+                if is_label(operands[-1]):
+                    operands = list(operands[:-1]) + [self.label_addr(operands[-1]) - addr - 4]
+            if mnemonic == '.incbin':
+                # the length is fixed as laid out
+                path, offset, length = incbin(operands)
+                operands = [operands[0], str(offset), str(length)]
+            if mnemonic == '.int':
+                def go(operand):
+                    val = self.eval_expr(operand)
+                    if not -0x80000000 <= val <= 0xffffffff:
+                        error('expression value too large: ' + hex(val))
+                    return val
+                try:
+                    vals = map(int_literal, operands)
+                except ValueError:
+                    vals = None
+                if vals and -0x80000000 <= min(vals) and max(vals) <= 0xffffffff:
+                    operands = vals
+                else:
+                    operands = map(go, operands)
             addr += calc_ofs(mnemonic, operands)
+            yield mnemonic, operands, filename, pos
+
+    def check_global(self, label):
+        if self.addrs[self.labels[label][self.filename]] < 0:
+            error('label \'{}\' is not declared'.format(label))
 
-def write(f, byterepr):
-    if args.k:
-        f.write("{} => x\"{:08x}\",\n".format(i, struct.unpack('<I', byterepr)[0]))
-    elif args.a:
-        fmt = """
+    def check_unused_label(self, label):
+        slot = self.labels[label][self.filename]
+        if not self.used[slot] and not (self.filename in self.library and self.globals[slot]):
+            self.warning('unused label \'{}\''.format(label))
+
+
+# ----------------------------------------------------------------------
+#       output
+# ----------------------------------------------------------------------
+
+rs232c_fmt = """
         wait for BR; RS_RX <= '0';
         wait for BR; RS_RX <= '{}';
         wait for BR; RS_RX <= '{}';
@@ -1092,25 +2137,719 @@ def write(f, byterepr):
         wait for (2 * BR);
 
 """
-        for b in byterepr:
-            a = ord(b)
-            ps = ['1' if a & (1 << j) else '0' for j in range(8)]
-            f.write(fmt.format(*ps))
-    else:
-        f.write(byterepr)
-
-with open(args.o, 'w') as f:
-    size = 0
-    if not (args.c or args.k):
-        write(f, 'size')
-    for i, (mnemonic, operands, filename, pos) in enumerate(lines2):
-        byterepr = code(mnemonic, operands)
-        write(f, byterepr)
-        size += len(byterepr)
-    if args.k:
+
+# stimulus of each byte value, and the same as a VHDL literal for --loop
+rs232c_bytes = [rs232c_fmt.format(*['1' if a & (1 << j) else '0' for j in range(8)]) for a in range(256)]
+rs232c_hex = ['x"{:02x}"'.format(a) for a in range(256)]
+
+rs232c_loop_fmt = """
+    rs232c_send: process
+        type rs232c_data_t is array (0 to {}) of std_logic_vector(7 downto 0);
+        constant rs232c_data : rs232c_data_t := (
+{}
+        );
+    begin
+        for i in rs232c_data'range loop
+            wait for BR; RS_RX <= '0';
+            for j in 0 to 7 loop
+                wait for BR; RS_RX <= rs232c_data(i)(j);
+            end loop;
+            wait for BR; RS_RX <= '1';
+
+            wait for (2 * BR);
+        end loop;
+        wait;
+    end process;
+"""
+
+# An object file is obj_magic, the digest of the asm.py which wrote it, and
+# the marshalled expanded lines of its files.  The lines are in the form
+# the assembler keeps internally, so an object is only linked by the same
+# asm.py.
+obj_magic = 'GAIAOBJ\x01'
+
+def write_object(f, files):
+    f.write(obj_magic + asm_digest() + marshal.dumps(files))
+
+def read_object(filename, data):
+    start = len(obj_magic) + len(asm_digest())
+    if data[len(obj_magic):start] != asm_digest():
+        fatal('object file written by another version of the assembler: ' + filename)
+    try:
+        return marshal.loads(data[start:])
+    except (ValueError, EOFError, TypeError):
+        fatal('broken object file: ' + filename)
+
+asm_digests = []
+
+def asm_digest():
+    # objects and cache entries are only valid for the assembler that wrote them
+    if not asm_digests:
+        with open(os.path.splitext(__file__)[0] + '.py', 'rb') as f:
+            asm_digests.append(hashlib.sha1(f.read()).digest())
+    return asm_digests[0]
+
+def cache_salt():
+    return 'GAIAEXP\x01' + asm_digest()
+
+def hash_file(digest, filename):
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(0x10000), ''):
+            digest.update(chunk)
+
+# Cache directory entries are marshalled values: '<hash>.exp' holds the
+# expansion of one source file, '<hash>.out' the outputs of a whole run.
+
+def read_cache(cache_dir, name):
+    path = os.path.join(cache_dir, name)
+    try:
+        with open(path, 'rb') as f:
+            ret = marshal.loads(f.read())
+        os.utime(path, None)
+        return ret
+    except (IOError, OSError, ValueError, EOFError, TypeError):
+        return None
+
+# bytes in each cache directory as last counted by this process; kept up
+# to date by write_cache() so that the directory is only listed again when
+# it may have grown beyond its limit
+cache_totals = {}
+
+def write_cache(cache_dir, name, value, limit):
+    # entries are written atomically; when the directory grows beyond
+    # 'limit' bytes, the least recently used entries are removed until it is
+    # down to three quarters of that, so that it is not listed on every write
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        tmp = os.path.join(cache_dir, '{}.{}.tmp'.format(name, os.getpid()))
+        with open(tmp, 'wb') as f:
+            marshal.dump(value, f)
+            size = f.tell()
+        os.rename(tmp, os.path.join(cache_dir, name))
+        total = cache_totals.get(cache_dir)
+        if total is not None and total + size <= limit:
+            cache_totals[cache_dir] = total + size
+            return
+        entries = []
+        for entry in os.listdir(cache_dir):
+            if entry.endswith(('.exp', '.out')):
+                st = os.stat(os.path.join(cache_dir, entry))
+                entries.append((st.st_mtime, st.st_size, entry))
+        total = sum(size for _, size, _ in entries)
+        if total > limit:
+            for mtime, size, entry in sorted(entries):
+                if total <= limit * 3 / 4:
+                    break
+                os.remove(os.path.join(cache_dir, entry))
+                total -= size
+        cache_totals[cache_dir] = total
+    except (IOError, OSError):
+        pass
+
+def output_key(options, filenames):
+    # key of the outputs of a run: the options and the input contents
+    digest = hashlib.sha1(cache_salt() + repr(options))
+    try:
+        for filename in filenames:
+            hash_file(digest, filename)
+            digest.update('\0')
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+def file_digest(filename):
+    digest = hashlib.sha1()
+    try:
+        hash_file(digest, filename)
+    except (IOError, OSError):
+        return None
+    return digest.hexdigest()
+
+def write_deps(f, targets, deps):
+    # make rule for the outputs, plus an empty rule for each input so that
+    # make does not fail when an input is removed
+    quote = lambda path: path.replace(' ', '\\ ')
+    f.write('{}: {}\n'.format(' '.join(map(quote, targets)), ' \\\n  '.join(map(quote, deps))))
+    for dep in deps:
+        f.write('\n{}:\n'.format(quote(dep)))
+
+def image_chunks(size, zeros):
+    # (start, end, zero) ranges covering an image of size bytes, where the
+    # zero ones are left out of the file.  Lengths are multiples of 4, so
+    # only the aligned part of each .zero range (if at least 16 bytes) is
+    # left out
+    pos = 0
+    for start, n in zeros:
+        start, end = (start + 3) & ~3, (start + n) & ~3
+        if end - start < 16:
+            continue
+        if start > pos:
+            yield pos, start, False
+        yield start, end, True
+        pos = end
+    if pos < size:
+        yield pos, size, False
+
+def zero_fill_image(image, zeros):
+    # Image with the zero-filled (.zero/.bss) ranges left out.  The size
+    # word has bit 31 set and is followed by chunks: a length word and that
+    # many bytes, or a length word with bit 31 set for a range the loader
+    # clears.
+    out = [word.pack(0x80000000 | len(image))]
+    for start, end, zero in image_chunks(len(image), zeros):
+        if zero:
+            out.append(word.pack(0x80000000 | end - start))
+        else:
+            out += [word.pack(end - start), str(image[start:end])]
+    return bytearray(''.join(out))
+
+def compress_image(image, zeros=()):
+    # LZ77-compressed image for serial loading.  The size word has bit 30
+    # set and is followed by the compressed bytes (see lz_compress()).
+    # With zero-filled ranges, it also has bit 31 set and the chunks are as
+    # in zero_fill_image(), except that the bytes of each stored chunk are
+    # compressed on their own.
+    chunks = list(image_chunks(len(image), zeros))
+    if not any(zero for _, _, zero in chunks):
+        return bytearray(word.pack(0x40000000 | len(image)) + lz_compress(str(image)))
+    out = [word.pack(0xc0000000 | len(image))]
+    for start, end, zero in chunks:
+        if zero:
+            out.append(word.pack(0x80000000 | end - start))
+        else:
+            out += [word.pack(end - start), lz_compress(str(image[start:end]))]
+    return bytearray(''.join(out))
+
+def lz_compress(data):
+    # Tokens which give data: a byte t < 0x80 and t + 1 literal bytes, or
+    # a byte t >= 0x80 and a 16-bit little-endian distance d, which copy
+    # (t & 0x7f) + 3 bytes from d bytes back.  Matches are found through
+    # hash chains of 3-byte strings, one step lazily.
+    n = len(data)
+    heads = {}
+    prev = array.array('i', [-1]) * n
+    out = []
+
+    def insert(i):
+        key = data[i:i + 3]
+        prev[i] = heads.get(key, -1)
+        heads[key] = i
+
+    def find(i):
+        best, dist = 0, 0
+        if i + 3 > n:
+            return best, dist
+        j = heads.get(data[i:i + 3], -1)
+        limit = min(130, n - i)
+        for _ in xrange(32):
+            if j < 0 or i - j > 0xffff:
+                break
+            if data[j + best] == data[i + best]:
+                l = 3
+                while l < limit and data[j + l] == data[i + l]:
+                    l += 1
+                if l > best:
+                    best, dist = l, i - j
+                    if l == limit:
+                        break
+            j = prev[j]
+        return best, dist
+
+    def literals(start, end):
+        for k in xrange(start, end, 128):
+            m = min(128, end - k)
+            out.append(chr(m - 1) + data[k:k + m])
+
+    i = lit = 0
+    match = find(0)
+    while i < n:
+        length, dist = match
+        insert(i)
+        match = find(i + 1) if i + 1 < n else (0, 0)
+        if length >= 3 and match[0] <= length:
+            literals(lit, i)
+            out.append(chr(0x80 | length - 3) + struct.pack('<H', dist))
+            for k in xrange(i + 1, i + length):
+                insert(k)
+            i += length
+            lit = i
+            match = find(i) if i < n else (0, 0)
+        else:
+            i += 1
+    literals(lit, n)
+    return ''.join(out)
+
+def write_image(f, program, header=True, rs232c=False, vhdl=False, compress=False, loop=False):
+    image = program.image
+    if vhdl:
+        words = struct.unpack('<{}I'.format(len(image) >> 2), str(image[:len(image) & ~3]))
+        f.write(''.join(["{} => x\"{:08x}\",\n".format(i, w) for i, w in enumerate(words)]))
         f.write("others => (others => '0')\n")
-    elif not args.c:
-        f.seek(0)
-        byterepr = ''.join(chr(size >> x & 255) for x in [0, 8, 16, 24])
-        write(f, byterepr)
+        return
+    if compress:
+        image = compress_image(image, program.zeros)
+    elif header and program.zeros:
+        image = zero_fill_image(image, program.zeros)
+    elif header:
+        image = word.pack(len(image)) + image
+    if rs232c and loop:
+        rows = (', '.join(map(rs232c_hex.__getitem__, image[i:i + 16]))
+                for i in xrange(0, len(image), 16))
+        f.write(rs232c_loop_fmt.format(len(image) - 1, ',\n'.join(' ' * 12 + row for row in rows)))
+    elif rs232c:
+        for i in xrange(0, len(image), 0x1000):
+            f.write(''.join(map(rs232c_bytes.__getitem__, image[i:i + 0x1000])))
+    else:
+        f.write(image)
+
+# --watch: the stamp and contents of each file written by rewrite_file()
+written_files = {}
 
+def rewrite_file(path, data):
+    # only the part which differs from what was written last time is
+    # written again, unless the file has been changed by someone else
+    old = written_files.get(path)
+    try:
+        st = os.stat(path)
+        old = old if old and old[0] == (st.st_mtime, st.st_size) else None
+    except OSError:
+        old = None
+    if old is None:
+        with open(path, 'wb') as f:
+            f.write(data)
+    else:
+        old = old[1]
+        start = common_prefix(old, data)
+        if start < len(old) or len(old) != len(data):
+            end = len(data)
+            if len(old) == len(data):
+                end -= common_prefix(old[::-1], data[::-1])
+            with open(path, 'r+b') as f:
+                f.seek(start)
+                f.write(data[start:end])
+                f.truncate(len(data))
+    st = os.stat(path)
+    written_files[path] = (st.st_mtime, st.st_size), data
+
+def common_prefix(a, b, block=0x1000):
+    # length of the common prefix of two strings, compared block by block
+    n = min(len(a), len(b))
+    i = 0
+    while i < n and a[i:i + block] == b[i:i + block]:
+        i += block
+    while i < n and a[i] == b[i]:
+        i += 1
+    return min(i, n)
+
+class TimeReport(object):
+    # --time-report: wall and CPU time per phase of a build, and the maximum
+    # resident set size of the process when each phase was last left.  The
+    # latter never goes down, so it is the high-water mark so far rather than
+    # the memory used by the phase; the RSS growth of a phase is how much it
+    # went up while the phase ran.  Phases nest; time and growth in an inner
+    # phase are not counted in the outer one, except that the growth while
+    # lines are taken through iterate() goes to the outer phase.  A disabled
+    # report measures nothing.
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.start = time.time(), time.clock()
+        self.mark = self.start
+        self.start_rss = self.rss_mark = max_rss() if enabled else 0
+        self.names = []
+        self.wall = {}
+        self.cpu = {}
+        self.max_rss = {}
+        self.growth = {}
+        self.stack = []
+
+    def switch(self):
+        now = time.time(), time.clock()
+        rss = max_rss()
+        if self.stack:
+            name = self.stack[-1]
+            self.wall[name] += now[0] - self.mark[0]
+            self.cpu[name] += now[1] - self.mark[1]
+            self.growth[name] += rss - self.rss_mark
+        self.mark = now
+        self.rss_mark = rss
+
+    def enter(self, name):
+        self.switch()
+        if name not in self.wall:
+            self.names.append(name)
+            self.wall[name] = self.cpu[name] = 0.0
+            self.max_rss[name] = self.growth[name] = 0
+        self.stack.append(name)
+
+    def leave(self):
+        self.switch()
+        name = self.stack.pop()
+        self.max_rss[name] = self.rss_mark
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self.enter(name)
+        try:
+            yield
+        finally:
+            self.leave()
+
+    def iterate(self, name, lines):
+        # charges the time taken to produce each line to the phase
+        if not self.enabled:
+            return lines
+        return self.timed_lines(name, lines)
+
+    def timed_lines(self, name, lines):
+        # enter() and leave() inlined, as this runs for every line
+        self.enter(name)
+        self.leave()
+        stack, wall, cpu = self.stack, self.wall, self.cpu
+        now, clock = time.time, time.clock
+        it = iter(lines)
+        while True:
+            t, c = now(), clock()
+            if stack:
+                outer = stack[-1]
+                wall[outer] += t - self.mark[0]
+                cpu[outer] += c - self.mark[1]
+            stack.append(name)
+            self.mark = t, c
+            try:
+                line = next(it)
+            except StopIteration:
+                break
+            finally:
+                t, c = now(), clock()
+                wall[name] += t - self.mark[0]
+                cpu[name] += c - self.mark[1]
+                stack.pop()
+                self.mark = t, c
+            yield line
+        self.max_rss[name] = max_rss()
+
+    def phases(self):
+        # [(name, wall, cpu, max RSS so far in KB, RSS growth in KB)], the
+        # last one for the whole build, where it is the peak of the process
+        ret = [(name, self.wall[name], self.cpu[name], self.max_rss[name], self.growth[name])
+               for name in self.names]
+        now, rss = (time.time(), time.clock()), max_rss()
+        return ret + [('total', now[0] - self.start[0], now[1] - self.start[1], rss, rss - self.start_rss)]
+
+def max_rss():
+    # maximum resident set size of this process so far in KB
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+def write_time_report(f, phases, counters, macros):
+    f.write('time report:\n')
+    f.write('  {:12} {:>9} {:>9} {:>14} {:>11}\n'.format('phase', 'wall', 'cpu', 'max RSS so far', 'RSS growth'))
+    for name, wall, cpu, rss, growth in phases:
+        f.write('  {:12} {:>8.3f}s {:>8.3f}s {:>11.1f} MB {:>8.1f} MB\n'.format(name, wall, cpu, rss / 1024.0,
+                                                                           growth / 1024.0))
+    f.write('counters:\n')
+    for name, value in counters:
+        if isinstance(value, list):
+            value = '{} ({})'.format(len(value), ', '.join(map(str, value)))
+        f.write('  {:28} {}\n'.format(name, value))
+    if macros:
+        f.write('macro expansions:\n')
+        for name, n in sorted(macros.items(), key=lambda x: (-x[1], x[0])):
+            f.write('  {:28} {}\n'.format(name, n))
+
+def write_time_report_json(f, phases, counters, macros):
+    json.dump({'phases': [{'phase': name, 'wall': wall, 'cpu': cpu, 'max_rss_kb': rss, 'rss_growth_kb': growth}
+                          for name, wall, cpu, rss, growth in phases],
+               'counters': dict(counters),
+               'macros': macros}, f, sort_keys=True)
+    f.write('\n')
+
+
+# ----------------------------------------------------------------------
+#       main process
+# ----------------------------------------------------------------------
+
+def main(argv=None, cache=None):
+    # parse command line arguments
+    argparser = argparse.ArgumentParser(usage='%(prog)s [options] file...')
+    argparser.add_argument('inputs', nargs='*', help='input files', metavar='file...')
+    argparser.add_argument('-a', help='output as rs232c send test format', action='store_true')
+    argparser.add_argument('-c', help='do not append file header', action='store_true')
+    argparser.add_argument('-e', help='set entry point address', metavar='<integer>')
+    argparser.add_argument('-f', help='append label to end of program', metavar='<label>')
+    argparser.add_argument('-j', help='expand input files in <integer> processes', metavar='<integer>', default=1, type=int)
+    argparser.add_argument('-k', help='output as array of std_logic_vector format', action='store_true')
+    argparser.add_argument('-l', help='set library file to <file>', metavar='<file>', action='append')
+    argparser.add_argument('-o', help='set output file to <file>', metavar='<file>', default='a.out')
+    argparser.add_argument('-O', help='set optimization level', metavar='<integer>', default=2, type=int)
+    argparser.add_argument('-r', help='do not insert main label jump instruction', action='store_true')
+    argparser.add_argument('-s', help='output preprocessed assembly', action='store_true')
+    argparser.add_argument('-start', help='same as -t (deprecated)', metavar='<label>', dest='t')
+    argparser.add_argument('-t', help='start execution from <label>', metavar='<label>')
+    argparser.add_argument('-v', help='output more detailed assembly than -s', action='store_true')
+    argparser.add_argument('-z', help='compress output image for bootloader', action='store_true')
+    argparser.add_argument('-MD', help='write make dependencies of the output', action='store_true')
+    argparser.add_argument('-MF', help='with -MD, write dependencies to <file>', metavar='<file>')
+    argparser.add_argument('-Wno-unused-label', help='disable unused label warning', action='store_true')
+    argparser.add_argument('-Wr29', help='enable use of r29 warning', action='store_true')
+    argparser.add_argument('--loop', help='with -a, output a process looping over a constant array', action='store_true')
+    argparser.add_argument('--stream', help='read the sources again for each pass instead of keeping them', action='store_true')
+    argparser.add_argument('--cache-dir', help='keep expanded source files and outputs in <dir>', metavar='<dir>')
+    argparser.add_argument('--cache-size', help='with --cache-dir, limit the cache to <integer> MB', metavar='<integer>', default=256, type=int)
+    argparser.add_argument('--time-report', help='print time, max RSS so far (a cumulative high-water mark) and its growth per phase, and hot-path counters', action='store_true')
+    argparser.add_argument('--time-report-json', help='write the time report as JSON to <file> (- for stdout)', metavar='<file>')
+    argparser.add_argument('--watch', help='assemble again whenever an input changes', action='store_true')
+    argparser.add_argument('--obj', help='output relocatable object file for later linking', action='store_true')
+    argparser.add_argument('--serve', help='run as assembler server reading jobs from stdin', action='store_true')
+    argparser.add_argument('--socket', help='with --serve, accept jobs on unix socket <path>', metavar='<path>')
+    argparser.add_argument('--workers', help='with --serve, number of worker processes', metavar='<integer>', default=1, type=int)
+    args = argparser.parse_args(argv)
+    for name in ['serve', 'watch']:
+        if getattr(args, name) and cache is not None:
+            argparser.print_usage(sys.stderr)
+            report('fatal error', 31, 'argument --{}: not allowed in a job'.format(name))
+            sys.exit(1)
+    if args.serve:
+        return serve(args.socket, args.workers)
+    if args.inputs == []:
+        argparser.print_help(sys.stderr)
+        sys.exit(1)
+    entry_point = 0x2000
+    if args.e:
+        success, entry_point = parse_int(args.e)
+        msg = None
+        if not success:
+            msg = 'argument -e: expected integer: ' + args.e
+        elif entry_point & 3 != 0:
+            msg = 'argument -e: entry address must be a multiple of 4'
+        elif entry_point < 0:
+            msg = 'argument -e: entry address must be zero or positive'
+        if msg:
+            argparser.print_usage(sys.stderr)
+            report('fatal error', 31, msg)
+            sys.exit(1)
+    if args.z and (args.c or args.k):
+        argparser.print_usage(sys.stderr)
+        report('fatal error', 31, 'argument -z: not allowed with -c or -k')
+        sys.exit(1)
+
+    asm = Assembler(entry_point=entry_point,
+                    start_label=args.t or 'main',
+                    opt_level=args.O,
+                    start_jump=not args.r,
+                    end_label=args.f,
+                    warn_unused_label=not args.Wno_unused_label,
+                    warn_r29=args.Wr29,
+                    cache=cache,
+                    stream=args.stream,
+                    cache_dir=args.cache_dir,
+                    cache_limit=args.cache_size << 20,
+                    cache_sources=args.watch,
+                    cache_encoded=args.watch and not (args.s or args.v or args.Wr29),
+                    jobs=args.j, keep_lines=args.s or args.v)
+    if args.obj and args.l:
+        argparser.print_usage(sys.stderr)
+        report('fatal error', 31, 'argument -l: not allowed with --obj')
+        sys.exit(1)
+    targets = [args.o] + ([args.o + '.s'] if args.s or args.v else [])
+    deps = (args.l or []) + args.inputs
+    if args.time_report or args.time_report_json:
+        build_once = lambda: timed_build(asm, args, entry_point, targets, deps)
+    else:
+        build_once = lambda: build(asm, args, entry_point, targets, deps)
+    if args.watch:
+        return watch(lambda: deps + asm.binaries, build_once)
+    status = build_once()
+    if status:
+        sys.exit(status)
+    return 0
+
+def timed_build(asm, args, entry_point, targets, deps):
+    asm.timer = TimeReport()
+    asm.clear_counters()
+    hits, misses = expansion_cache.hits, expansion_cache.misses
+    status = build(asm, args, entry_point, targets, deps)
+    phases = asm.timer.phases()
+    counters = [('eval_expr', asm.expr_evals),
+                ('label_addr', asm.label_lookups),
+                ('relax_grown', asm.relax_passes),
+                ('expansion_cache_hits', expansion_cache.hits - hits),
+                ('expansion_cache_misses', expansion_cache.misses - misses),
+                ('image_bytes', asm.image_size),
+                ('output_bytes', os.path.getsize(args.o) if os.path.isfile(args.o) else 0)]
+    if args.time_report:
+        write_time_report(sys.stderr, phases, counters, asm.macro_counts)
+    if args.time_report_json == '-':
+        write_time_report_json(sys.stdout, phases, counters, asm.macro_counts)
+    elif args.time_report_json:
+        with open(args.time_report_json, 'w') as f:
+            write_time_report_json(f, phases, counters, asm.macro_counts)
+    return status
+
+def build(asm, args, entry_point, targets, deps):
+    key = None
+    timer = asm.timer or TimeReport(False)
+    if args.cache_dir and not args.obj:
+        # outputs of a previous run with the same options and inputs
+        options = (entry_point, args.t, args.O, args.r, args.f, args.k, args.a, args.loop, args.c, args.z,
+                   args.s, args.v, args.Wno_unused_label, args.Wr29, args.l, args.inputs)
+        with timer.phase('cache'):
+            key = output_key(options, deps)
+            outputs = key and read_cache(args.cache_dir, key + '.out')
+        # files included by .incbin are checked separately
+        if outputs and all(file_digest(path) == digest for path, digest in outputs[3]):
+            warnings, image, listing, binaries = outputs
+            map(report_warning, warnings)
+            if listing is not None:
+                with open(args.o + '.s', 'w') as f:
+                    f.write(listing)
+            with open(args.o, 'w') as f:
+                f.write(image)
+            if args.MD:
+                with open(args.MF or os.path.splitext(args.o)[0] + '.d', 'w') as f:
+                    write_deps(f, targets, deps + [path for path, _ in binaries])
+            return 0
+    try:
+        if args.obj:
+            files = asm.compile(args.inputs)
+        else:
+            program = asm.assemble(args.inputs, args.l or [])
+    except AsmError as e:
+        map(report_warning, asm.warnings)
+        report_error(e)
+        return 1
+    map(report_warning, asm.warnings)
+    if args.MD:
+        with open(args.MF or os.path.splitext(args.o)[0] + '.d', 'w') as f:
+            write_deps(f, targets, deps + asm.binaries)
+    if args.obj:
+        with open(args.o, 'wb') as f:
+            write_object(f, files)
+        return 0
+
+    listing = None
+    if args.s or args.v:
+        with open(args.o + '.s', 'w') as f, timer.phase('listing'):
+            buf = StringIO.StringIO() if key else f
+            program.listing(buf, args.v)
+            if key:
+                listing = buf.getvalue()
+                f.write(listing)
+    with timer.phase('output'):
+        write = functools.partial(write_image, program=program, header=not args.c, rs232c=args.a, vhdl=args.k,
+                                  compress=args.z, loop=args.loop)
+        if key or args.watch:
+            image = StringIO.StringIO()
+            write(image)
+            if args.watch:
+                rewrite_file(args.o, image.getvalue())
+            else:
+                with open(args.o, 'w') as f:
+                    f.write(image.getvalue())
+        else:
+            with open(args.o, 'w') as f:
+                write(f)
+    if key:
+        binaries = [(path, file_digest(path)) for path in asm.binaries]
+        write_cache(args.cache_dir, key + '.out', (asm.warnings, image.getvalue(), listing, binaries),
+                    args.cache_size << 20)
+    return 0
+
+def watch(filenames, build):
+    # build, then build again whenever one of the inputs changes on disk
+    stamps = ()
+    try:
+        while True:
+            try:
+                new = [(st.st_mtime, st.st_size) for st in map(os.stat, filenames())]
+            except OSError:
+                new = None
+            if new != stamps and (new is not None or stamps == ()):
+                stamps = new
+                if build() == 0:
+                    report('note', 36, 'output updated')
+            time.sleep(0.2)
+    except KeyboardInterrupt:
+        return 0
+
+
+# ----------------------------------------------------------------------
+#       server mode
+# ----------------------------------------------------------------------
+
+# A job is one line: either a JSON object {"id": ..., "args": [...], "cwd": ...}
+# or a plain asm.py command line.  Each job is answered with one JSON line
+# {"id": ..., "status": <exit status>, "diagnostics": <stderr text>,
+# "output": <stdout text>}; nothing else is written to the response stream.
+# Jobs may be answered out of order when more than one worker is used.
+
+job_cache = {}
+
+def run_job((n, line)):
+    import shlex, traceback
+    job = {'id': n}
+    stdout, stderr, cwd = sys.stdout, sys.stderr, os.getcwd()
+    sys.stdout, sys.stderr = StringIO.StringIO(), StringIO.StringIO()
+    try:
+        if line.lstrip().startswith('{'):
+            job.update(json.loads(line))
+        else:
+            job['args'] = shlex.split(line)
+        if job.get('cwd'):
+            os.chdir(job['cwd'])
+        status = main(job.get('args', []), job_cache)
+    except SystemExit as e:
+        status = e.code if isinstance(e.code, int) else 1
+    except Exception:
+        traceback.print_exc()
+        status = 1
+    finally:
+        output, diagnostics = sys.stdout.getvalue(), sys.stderr.getvalue()
+        sys.stdout, sys.stderr = stdout, stderr
+        os.chdir(cwd)
+    return json.dumps({'id': job['id'], 'status': status, 'diagnostics': diagnostics, 'output': output})
+
+def init_worker():
+    import signal
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+def serve_stream(pool, rfile, wfile):
+    jobs = (job for job in enumerate(iter(rfile.readline, ''), 1) if job[1].strip())
+    for res in pool.imap_unordered(run_job, jobs):
+        wfile.write(res + '\n')
+        wfile.flush()
+
+def serve(socket_path, workers):
+    # imported here so that the plain command line does not pay for them
+    import multiprocessing
+    import SocketServer
+    pool = multiprocessing.Pool(max(workers, 1), init_worker)
+    if socket_path is None:
+        serve_stream(pool, sys.stdin, sys.stdout)
+        pool.close()
+        pool.join()
+        return 0
+
+    class Handler(SocketServer.StreamRequestHandler):
+        def handle(self):
+            serve_stream(pool, self.rfile, self.wfile)
+
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    server = SocketServer.ThreadingUnixStreamServer(socket_path, Handler)
+    server.daemon_threads = True
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        os.unlink(socket_path)
+        pool.terminate()
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,160 @@
+#!/usr/bin/env python2.7
+# Seeded generator of large assembly programs for benchmarking asm.py.
+#
+# The program is spread over main.s, part*.s and library files lib*.s (to
+# be passed with -l).  It consists of functions with a dense call graph
+# across all files, short branches within functions, branches to nearby
+# functions, tables of label addresses, numeric .int tables and .string
+# data.  The size is the approximate image size in bytes.
+
+import os
+import random
+import argparse
+
+alu_ops = ['add', 'sub', 'and', 'or', 'xor', 'cmplt', 'cmpeq', 'cmpult']
+shift_ops = ['shl', 'shr', 'sar']
+branches = ['blt', 'ble', 'bgt', 'bge', 'bne', 'beq']
+
+# branches reach +-128KB; targets are picked within this estimated distance
+branch_reach = 0x10000
+
+def reg(rnd):
+    return 'r' + str(rnd.randint(1, 27))
+
+def gen_function(rnd, name, funcs, datas, near):
+    # returns the lines of one function and its estimated size in bytes;
+    # near lists the functions that a branch can reach
+    out = ['', '.global ' + name, name + ':', '    enter   8']
+    size = 8
+    nblocks = rnd.randint(2, 8)
+    for b in range(nblocks):
+        out.append('{}_{}:'.format(name, b))
+        for _ in range(rnd.randint(4, 24)):
+            k = rnd.random()
+            if k < 0.35:
+                op = rnd.choice(alu_ops)
+                if rnd.random() < 0.5:
+                    out.append('    {:7} {}, {}, {}'.format(op, reg(rnd), reg(rnd), reg(rnd)))
+                else:
+                    out.append('    {:7} {}, {}, {}'.format(op, reg(rnd), reg(rnd), rnd.randint(-128, 127)))
+                size += 4
+            elif k < 0.45:
+                op = rnd.choice(shift_ops)
+                out.append('    {:7} {}, {}, {}'.format(op, reg(rnd), reg(rnd), rnd.randint(1, 31)))
+                size += 4
+            elif k < 0.55:
+                out.append('    mov     {}, {}'.format(reg(rnd), rnd.choice([rnd.randint(-0x8000, 0x7fff),
+                                                                             rnd.randint(0, 0xffffffff)])))
+                size += 8
+            elif k < 0.65:
+                out.append('    mov     {}, [rbp - {}]'.format(reg(rnd), rnd.randrange(4, 64, 4)))
+                out.append('    mov     [rbp - {}], {}'.format(rnd.randrange(4, 64, 4), reg(rnd)))
+                size += 8
+            elif k < 0.72 and datas:
+                label, length = rnd.choice(datas)
+                ofs = rnd.randrange(0, length, 4)
+                if rnd.random() < 0.5:
+                    out.append('    mov     {}, [{} + {}]'.format(reg(rnd), label, ofs))
+                else:
+                    out.append('    mov     {}, {} + {}'.format(reg(rnd), label, ofs))
+                size += 8
+            elif k < 0.88 and funcs:
+                out.append('    call    ' + rnd.choice(funcs))
+                size += 28
+            elif k < 0.94:
+                # short branch within the function
+                out.append('    {:7} {}, {}, {}_{}'.format(rnd.choice(branches), reg(rnd), reg(rnd),
+                                                           name, rnd.randrange(nblocks)))
+                size += 8
+            else:
+                # branch to a nearby function
+                if near:
+                    out.append('    bnz     {}, {}'.format(reg(rnd), rnd.choice(near)))
+                    size += 4
+    out += ['    leave', '    ret']
+    return out, size + 8
+
+def gen_data(rnd, name, funcs):
+    # returns the lines of one data block, its label and size in bytes
+    k = rnd.random()
+    out = ['', '.global ' + name, name + ':']
+    if k < 0.4 and funcs:
+        n = rnd.randint(8, 64)
+        for i in range(0, n, 8):
+            out.append('    .int    ' + ', '.join(rnd.choice(funcs) for _ in range(min(8, n - i))))
+        size = n * 4
+    elif k < 0.7:
+        n = rnd.randint(16, 256)
+        for i in range(0, n, 16):
+            out.append('    .int    ' + ', '.join(str(rnd.randint(-0x80000000, 0x7fffffff))
+                                                  for _ in range(min(16, n - i))))
+        size = n * 4
+    else:
+        size = 0
+        for _ in range(rnd.randint(1, 8)):
+            s = ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz ,.!?') for _ in range(rnd.randint(4, 60)))
+            out.append('    .string "{}\\n"'.format(s))
+            size += len(s) + 1
+        out.append('    .align  4')
+        size = (size + 3) & ~3
+    return out, size
+
+def generate(size, seed=1, files=4, libs=2):
+    # returns [(filename, lines)]; files starting with 'lib' are libraries
+    rnd = random.Random(seed)
+    names = ['main.s'] + ['part{}.s'.format(i) for i in range(1, files)] + \
+            ['lib{}.s'.format(i) for i in range(libs)]
+    texts = dict((name, []) for name in names)
+    sizes = dict((name, 0) for name in names)
+    recent = dict((name, []) for name in names)
+    funcs = []
+    datas = []
+    total = 0
+    k = 0
+    texts['main.s'] += ['.global main', 'main:', '    call    f0', '    halt']
+    while total < size or not funcs:
+        # libraries get a quarter of the code
+        if not funcs:
+            name = 'main.s'
+        elif names[files:] and rnd.random() < 0.25:
+            name = rnd.choice(names[files:])
+        else:
+            name = rnd.choice(names[:files])
+        label = ('d{}' if funcs and rnd.random() < 0.15 else 'f{}').format(k)
+        if label[0] == 'd':
+            lines, n = gen_data(rnd, label, funcs)
+            datas.append((label, n))
+        else:
+            # functions earlier in the same file within branch_reach
+            near = [f for f, addr in recent[name] if sizes[name] - addr < branch_reach]
+            lines, n = gen_function(rnd, label, funcs, datas, near)
+            funcs.append(label)
+            recent[name] = recent[name][-63:] + [(label, sizes[name])]
+        texts[name] += lines
+        sizes[name] += n
+        total += n
+        k += 1
+    return [(filename, texts[filename]) for filename in names]
+
+def parse_size(s):
+    units = {'K': 1 << 10, 'M': 1 << 20}
+    if s[-1:].upper() in units:
+        return int(float(s[:-1]) * units[s[-1:].upper()])
+    return int(s)
+
+def main():
+    argparser = argparse.ArgumentParser(usage='%(prog)s [options] size dir')
+    argparser.add_argument('size', help='approximate image size (e.g. 64K, 3.5M)')
+    argparser.add_argument('dir', help='output directory')
+    argparser.add_argument('--seed', help='random seed', default=1, type=int)
+    argparser.add_argument('--files', help='number of main files', default=4, type=int)
+    argparser.add_argument('--libs', help='number of library files', default=2, type=int)
+    args = argparser.parse_args()
+    if not os.path.isdir(args.dir):
+        os.makedirs(args.dir)
+    for name, lines in generate(parse_size(args.size), args.seed, args.files, args.libs):
+        with open(os.path.join(args.dir, name), 'w') as f:
+            f.write('\n'.join(lines) + '\n')
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,130 @@
+#!/usr/bin/env python2.7
+# Benchmark of asm.py on generated programs (see gen.py) of growing size.
+#
+# Each program is assembled with --time-report-json; the best of --repeat
+# runs is kept.  Results are compared against a baseline saved earlier
+# with --save, and the exit status is 1 if the total time or the peak
+# memory of any size grew by more than --tolerance.
+
+import sys
+import os
+import glob
+import json
+import subprocess
+import argparse
+
+import gen
+
+bench_dir = os.path.dirname(os.path.abspath(__file__))
+asm_path = os.path.join(os.path.dirname(bench_dir), 'asm.py')
+
+# allowed growth of time in seconds on top of --tolerance, as start-up time
+# dominates small programs and varies from run to run
+time_slack = 0.05
+
+def prepare(size, seed):
+    # generated inputs are kept under work/ and reused
+    path = os.path.join(bench_dir, 'work', '{}-{}'.format(seed, size))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+        for name, lines in gen.generate(gen.parse_size(size), seed):
+            with open(os.path.join(path, name), 'w') as f:
+                f.write('\n'.join(lines) + '\n')
+    inputs = sorted(glob.glob(os.path.join(path, 'main.s'))) + sorted(glob.glob(os.path.join(path, 'part*.s')))
+    libs = sorted(glob.glob(os.path.join(path, 'lib*.s')))
+    return path, inputs, libs
+
+def count_lines(filenames):
+    n = 0
+    for filename in filenames:
+        with open(filename) as f:
+            n += sum(1 for line in f if line.strip())
+    return n
+
+def run(size, seed, repeat, asm_args):
+    path, inputs, libs = prepare(size, seed)
+    cmd = [sys.executable, asm_path, '-Wno-unused-label', '--time-report-json', '-',
+           '-o', os.path.join(path, 'a.out')] + asm_args + inputs
+    for lib in libs:
+        cmd += ['-l', lib]
+    best = None
+    for _ in range(repeat):
+        p = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        out = p.communicate()[0]
+        if p.returncode != 0:
+            sys.exit('{}: asm.py failed'.format(size))
+        report = json.loads(out)
+        order = [phase['phase'] for phase in report['phases'] if phase['phase'] != 'total']
+        phases = dict((phase.pop('phase'), phase) for phase in report['phases'])
+        if best is None or phases['total']['wall'] < best['phases']['total']['wall']:
+            best = {'phases': phases, 'order': order, 'counters': report['counters']}
+    best['lines'] = count_lines(inputs + libs)
+    total = best['phases']['total']
+    best['lines_per_s'] = best['lines'] / total['wall']
+    best['bytes_per_s'] = best['counters']['image_bytes'] / total['wall']
+    return best
+
+def change(new, old):
+    return '{:+.1f}%'.format((float(new) / old - 1) * 100) if old else '-'
+
+def show(size, result, base):
+    total = result['phases']['total']
+    print '{:>6}: {:,} lines, {:,} bytes, {:.2f}s, {:,.0f} lines/s, {:,.0f} bytes/s, peak {:.1f} MB'.format(
+        size, result['lines'], result['counters']['image_bytes'], total['wall'],
+        result['lines_per_s'], result['bytes_per_s'], total['max_rss_kb'] / 1024.0)
+    for name in result['order'] + ['total']:
+        phase = result['phases'][name]
+        line = '        {:10} {:8.3f}s {:8.3f}s {:9.1f} MB'.format(name, phase['wall'], phase['cpu'],
+                                                                phase['max_rss_kb'] / 1024.0)
+        if base and name in base['phases']:
+            old = base['phases'][name]
+            line += '   {:>8} {:>8}'.format(change(phase['wall'], old['wall']),
+                                            change(phase['max_rss_kb'], old['max_rss_kb']))
+        print line
+
+def regressed(result, base, tolerance):
+    new, old = result['phases']['total'], base['phases']['total']
+    return new['wall'] > old['wall'] * (1 + tolerance) + time_slack or \
+           new['max_rss_kb'] > old['max_rss_kb'] * (1 + tolerance)
+
+def main():
+    argparser = argparse.ArgumentParser(usage='%(prog)s [options] [-- asm.py options]')
+    argparser.add_argument('--sizes', help='comma-separated image sizes', default='1K,16K,256K,1M,3.5M')
+    argparser.add_argument('--seed', help='random seed of the generator', default=1, type=int)
+    argparser.add_argument('--repeat', help='runs per size; the fastest is kept', default=3, type=int)
+    argparser.add_argument('--baseline', help='baseline file', default=os.path.join(bench_dir, 'baseline.json'))
+    argparser.add_argument('--save', help='save the results as the baseline', action='store_true')
+    argparser.add_argument('--tolerance', help='allowed growth of time and memory', default=0.1, type=float)
+    argparser.add_argument('asm_args', nargs=argparse.REMAINDER, help=argparse.SUPPRESS)
+    args = argparser.parse_args()
+    asm_args = args.asm_args[1:] if args.asm_args[:1] == ['--'] else args.asm_args
+
+    baseline = {}
+    if os.path.isfile(args.baseline) and not args.save:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    key = ' '.join(['seed={}'.format(args.seed)] + asm_args)
+    baseline = baseline.get(key, {})
+
+    results = {}
+    failed = []
+    for size in args.sizes.split(','):
+        results[size] = run(size, args.seed, args.repeat, asm_args)
+        show(size, results[size], baseline.get(size))
+        if size in baseline and regressed(results[size], baseline[size], args.tolerance):
+            failed.append(size)
+
+    if args.save:
+        saved = {}
+        if os.path.isfile(args.baseline):
+            with open(args.baseline) as f:
+                saved = json.load(f)
+        saved.setdefault(key, {}).update(results)
+        with open(args.baseline, 'w') as f:
+            json.dump(saved, f, indent=1, sort_keys=True)
+    if failed:
+        print 'regressed beyond {:.0%}: {}'.format(args.tolerance, ', '.join(failed))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
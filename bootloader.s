@@ -15,41 +15,92 @@
     write   r1, "\r\n"
     write   r1, "Waiting for input...\r\n"
 
-    # load file size
-    read    r1
-    read    r2
-    read    r3
-    read    r4
-    shl     r2, r2,  8
-    shl     r3, r3, 16
-    shl     r4, r4, 24
-    add     r1, r1, r2
-    add     r3, r3, r4
-    add     r1, r1, r3
+    # load file size; bit 31 set means the program is sent in chunks,
+    # each a length word followed by that many bytes, or a length word
+    # with bit 31 set for a zero-filled range (see zero_fill_image in asm.py)
+    # bit 30 set means the bytes are compressed (see compress_image)
+    call    read_word
+    mov     r1, r5
 
     # load program
     mov     r2, 0
     mov     r3, ENTRY_POINT
-    beq-    r1, r2, load_end
+    mov     r20, -1                 # KB count of last progress display
+    shr     r21, r1, 30             # 2: chunked, 1: compressed
+    shl     r1, r1, 2
+    shr     r1, r1, 2
+    mov     r10, r1                 # end of current chunk
+    blt     r21, 2, load_chunk
+    mov     r10, 0
+    br      load_cond
 load_loop:
     and     r9, r2, 1023
     bnz     r9, load_next
     call    display_progress
 load_next:
-    read    r5
-    read    r6
-    read    r7
-    read    r8
-    shl     r6, r6,  8
-    shl     r7, r7, 16
-    shl     r8, r8, 24
-    add     r5, r5, r6
-    add     r7, r7, r8
-    add     r5, r5, r7
+    call    read_word
     add     r4, r2, r3
     mov     [r4], r5
     add     r2, r2, 4
-    bne+    r1, r2, load_loop
+load_cond:
+    bne+    r2, r10, load_loop
+    beq-    r2, r1, load_end
+    call    read_word
+    bge     r5, 0, load_data
+    shl     r5, r5, 1
+    shr     r5, r5, 1
+    add     r10, r2, r5
+zero_loop:
+    add     r4, r2, r3
+    mov     [r4], r0
+    add     r2, r2, 4
+    bne+    r2, r10, zero_loop
+    br      load_cond
+load_data:
+    add     r10, r2, r5
+load_chunk:
+    and     r9, r21, 1
+    bnz     r9, load_lz
+    br      load_cond
+
+    # compressed chunk: literal runs and back references
+load_lz:
+    add     r4, r2, r3              # output pointer
+    add     r14, r10, r3            # end of chunk
+    br      lz_cond
+lz_loop:
+    read    r5
+    bge     r5, 128, lz_match
+    add     r6, r4, r5              # last byte of r5 + 1 literals
+lz_literal:
+    read    r7
+    movb    [r4], r7
+    add     r4, r4, 1
+    bge+    r6, r4, lz_literal
+    br      lz_cond
+lz_match:
+    read    r6
+    read    r7
+    shl     r7, r7, 8
+    add     r6, r6, r7
+    sub     r6, r4, r6              # source
+    sub     r5, r5, 125             # (r5 & 0x7f) + 3 bytes
+    add     r7, r4, r5
+lz_copy:
+    movb    r8, [r6]
+    movb    [r4], r8
+    add     r4, r4, 1
+    add     r6, r6, 1
+    bne+    r4, r7, lz_copy
+lz_cond:
+    sub     r2, r4, r3
+    shr     r9, r2, 10
+    beq+    r9, r20, lz_next
+    mov     r20, r9
+    call    display_progress
+lz_next:
+    bne+    r4, r14, lz_loop
+    br      load_cond
 load_end:
     write   r1, "\rLoading completed!              \r\n"
     write   r1, "\r\n"
@@ -58,6 +109,19 @@ load_end:
     jr      r3
 
 
+read_word:
+    read    r5
+    read    r6
+    read    r7
+    read    r8
+    shl     r6, r6,  8
+    shl     r7, r7, 16
+    shl     r8, r8, 24
+    add     r5, r5, r6
+    add     r7, r7, r8
+    add     r5, r5, r7
+    ret
+
 display_progress:
     enter
     write   r11, "\rLoading... ["
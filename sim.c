@@ -24,6 +24,8 @@
 
 #define PGCOLOR(va)    ((va) & 0x3000)
 
+#define TLB_SIZE     256 // direct-mapped, indexed by the low bits of the virtual page number
+
 uint32_t reg[32];
 uint32_t *mem;
 uint32_t mem_size = 0x400000;
@@ -36,6 +38,13 @@ int debug_enabled;
 long long inst_cnt;
 struct termios original_ttystate;
 
+// Software TLB: page number -> physical page.  Entries stay valid while no
+// page they were walked through is written (see pt_pages), and the whole
+// TLB is flushed when mmu_enabled or pd_addr is written.
+struct tlb_entry { uint32_t vpn, page; } tlb[TLB_SIZE], fetch_tlb;
+uint8_t *pt_pages; // physical pages of PDEs and PTEs read for the TLB
+long long tlb_hits, tlb_misses, fetch_hits, fetch_misses;
+
 char infile[128];
 int show_stat, boot_test, sim_intr_disabled;
 
@@ -59,6 +68,9 @@ void print_env(int show_vpc)
         fprintf(stderr, "<Current PC>: 0x%06x\n", pc);
     }
     fprintf(stderr, "<Number of executed instructions>: %lld\n", inst_cnt);
+    if (tlb_hits + tlb_misses + fetch_hits + fetch_misses)
+        fprintf(stderr, "<TLB>: %lld hits, %lld misses / <Fetch>: %lld hits, %lld misses\n",
+                tlb_hits, tlb_misses, fetch_hits, fetch_misses);
 }
 
 void error(char *, ...) __attribute__((noreturn));
@@ -150,19 +162,20 @@ uint32_t care_minus_zero(uint32_t x)
 
 // Warning: Error messages in "to_physical" MUST starts with "to_physical: " to prevent
 //          infinite loop in "error" function, which may call "to_physical" again.
-uint32_t to_physical(uint32_t addr)
+uint32_t page_walk(uint32_t addr)
 {
     uint32_t tmp;
-    if (!mmu_enabled) return addr;
     tmp = pd_addr | ((addr >> 22) << 2);
     if (tmp & 3 || tmp >= mem_size)
         error("to_physical: PDE address error: 0x%08x, Requested virtual address: 0x%08x", tmp, addr);
+    pt_pages[tmp >> 12] = 1;
     tmp = mem[tmp >> 2];
     if ((tmp & 1) == 0)
         error("to_physical: invalid PDE, Requested virtual address: 0x%08x", addr);
     tmp = (tmp & ~0x0fff) | (((addr >> 12) & 0x03ff) << 2);;
     if (tmp >= mem_size)
         error("to_physical: PTE address error: 0x%08x, Requested virtual address: 0x%08x", tmp, addr);
+    pt_pages[tmp >> 12] = 1;
     tmp = mem[tmp >> 2];
     if ((tmp & 1) == 0)
         error("to_physical: invalid PTE, Requested virtual address: 0x%08x", addr);
@@ -172,6 +185,49 @@ uint32_t to_physical(uint32_t addr)
     return tmp;
 }
 
+void tlb_flush()
+{
+    memset(tlb, 0xff, sizeof(tlb));
+    fetch_tlb.vpn = 0xffffffff;
+    memset(pt_pages, 0, mem_size >> 12);
+}
+
+uint32_t to_physical(uint32_t addr)
+{
+    struct tlb_entry *e;
+    if (!mmu_enabled) return addr;
+    e = &tlb[(addr >> 12) % TLB_SIZE];
+    if (e->vpn == addr >> 12) {
+        ++tlb_hits;
+    } else {
+        ++tlb_misses;
+        e->page = page_walk(addr) & ~0x0fff;
+        e->vpn = addr >> 12;
+    }
+    return e->page | (addr & 0x0fff);
+}
+
+// instruction fetches keep the page of the pc aside
+uint32_t fetch_physical(uint32_t addr)
+{
+    if (!mmu_enabled) return addr;
+    if (fetch_tlb.vpn == addr >> 12) {
+        ++fetch_hits;
+    } else {
+        ++fetch_misses;
+        fetch_tlb.page = to_physical(addr) & ~0x0fff;
+        fetch_tlb.vpn = addr >> 12;
+    }
+    return fetch_tlb.page | (addr & 0x0fff);
+}
+
+// a store to physical address addr
+void check_pt_write(uint32_t addr)
+{
+    if (pt_pages[addr >> 12])
+        tlb_flush();
+}
+
 int has_input()
 {
     int c;
@@ -232,6 +288,7 @@ void store(int ra, uint32_t disp, uint32_t x)
         error("store: address must be a multiple of 4: 0x%08x", addr);
     if (addr < mem_size) {
         mem[addr >> 2] = x;
+        check_pt_write(addr);
     } else {
         switch (addr) {
             case 0x80001000: serial_write(x); break;
@@ -239,8 +296,8 @@ void store(int ra, uint32_t disp, uint32_t x)
             case 0x80001104: intr_enabled = x; break;
             case 0x80001108: epc = x; break;
             case 0x8000110c: irq_num = x; break;
-            case 0x80001200: mmu_enabled = x; break;
-            case 0x80001204: pd_addr = x; break;
+            case 0x80001200: mmu_enabled = x; tlb_flush(); break;
+            case 0x80001204: pd_addr = x; tlb_flush(); break;
             default: error("store: exceeded %dMB limit: 0x%08x", mem_size >> 20, addr);
         }
     }
@@ -252,6 +309,7 @@ void store_byte(int ra, uint32_t disp, uint32_t x)
     if (addr >= mem_size)
         error("store_byte: exceeded %dMB limit: 0x%08x", mem_size >> 20, addr);
     *((uint8_t *)mem + addr) = x;
+    check_pt_write(addr);
 }
 
 void exec_alu(uint32_t inst)
@@ -380,6 +438,9 @@ void init_env()
 {
     free(mem);
     mem = malloc(mem_size);
+    free(pt_pages);
+    pt_pages = calloc(mem_size >> 12, 1);
+    tlb_flush();
     if (!boot_test)
         reg[30] = reg[31] = mem_size;
     pc = entry_point;
@@ -416,21 +477,82 @@ void restore_term()
     tcsetattr(fileno(stdin), TCSANOW, &original_ttystate);
 }
 
+uint32_t file_byte(FILE *fp)
+{
+    int c = fgetc(fp);
+    if (c == EOF)
+        error("load_file: reached EOF (actual size is less than header)");
+    return c;
+}
+
+uint32_t file_word(FILE *fp)
+{
+    uint32_t w = 0;
+    for (int i = 0; i < 32; i += 8)
+        w += file_byte(fp) << i;
+    return w;
+}
+
+void file_bytes(FILE *fp, uint32_t ofs, uint32_t len)
+{
+    for (uint32_t i = ofs; i < ofs + len; ++i)
+        *((uint8_t*)mem + entry_point + i) = file_byte(fp);
+}
+
+void file_lz(FILE *fp, uint32_t ofs, uint32_t len)
+{
+    // compressed bytes (asm.py -z): literal runs and back references
+    uint8_t *p = (uint8_t*)mem + entry_point;
+    for (uint32_t i = ofs; i < ofs + len; ) {
+        uint32_t t = file_byte(fp), n;
+        if (t < 0x80) {
+            n = t + 1;
+            if (n > ofs + len - i)
+                error("load_file: broken compressed image");
+            file_bytes(fp, i, n);
+        } else {
+            uint32_t dist = file_byte(fp);
+            dist += file_byte(fp) << 8;
+            n = (t & 0x7f) + 3;
+            if (dist == 0 || dist > i || n > ofs + len - i)
+                error("load_file: broken compressed image");
+            for (uint32_t j = i; j < i + n; ++j)
+                p[j] = p[j - dist];
+        }
+        i += n;
+    }
+}
+
 void load_file()
 {
     FILE *fp = fopen(infile, "r");
     if (fp == NULL)
         error(strerror(errno));
 
-    prog_size = 0;
-    for (int i = 0; i < 32; i += 8)
-        prog_size += fgetc(fp) << i;
-
-    for (uint32_t i = 0; i < prog_size; ++i) {
-        int c = fgetc(fp);
-        if (c == EOF)
-            error("load_file: reached EOF (actual size is less than header)");
-        *((uint8_t*)mem + entry_point + i) = c;
+    prog_size = file_word(fp);
+    int chunked = prog_size >> 31, compressed = (prog_size >> 30) & 1;
+    prog_size &= 0x3fffffff;
+
+    if (chunked) {
+        // chunked image: zero-filled (.zero/.bss) ranges are not stored
+        for (uint32_t i = 0; i < prog_size; ) {
+            uint32_t len = file_word(fp);
+            int zero = len >> 31;
+            len &= 0x7fffffff;
+            if (len == 0 || len > prog_size - i)
+                error("load_file: broken chunk header");
+            if (zero)
+                memset((uint8_t*)mem + entry_point + i, 0, len);
+            else if (compressed)
+                file_lz(fp, i, len);
+            else
+                file_bytes(fp, i, len);
+            i += len;
+        }
+    } else if (compressed) {
+        file_lz(fp, 0, prog_size);
+    } else {
+        file_bytes(fp, 0, prog_size);
     }
 
     if (fgetc(fp) != EOF)
@@ -451,7 +573,7 @@ void runsim()
             interrupt();
         if (debug_enabled)
             debug_hook();
-        phys_pc = to_physical(pc);
+        phys_pc = fetch_physical(pc);
         if (phys_pc >= mem_size)
             error("program counter out of range");
         if (mem[phys_pc >> 2] == HALT_CODE)
@@ -0,0 +1,954 @@
+#!/usr/bin/env python2.7
+# Reference simulator of the GAIA ISA.
+#
+# It follows sim.c instruction by instruction (registers, memory-mapped
+# serial/interrupt/MMU registers, interrupts and error messages), so test
+# programs run where sim.c is not built, straight from Assembler output.
+# Each word is decoded once, on its first fetch, into a handler with its
+# operands bound; a store drops the handler of the word it overwrites.
+
+import sys
+import os.path
+import math
+import array
+import struct
+import operator
+import argparse
+
+import asm
+
+
+class SimError(Exception):
+    pass
+
+class Halt(Exception):
+    pass
+
+
+# ----------------------------------------------------------------------
+#       instruction semantics
+# ----------------------------------------------------------------------
+
+halt_code = 0xffffffff
+
+irq_timer = 1
+irq_serial = 2
+irq_sysenter = 3
+
+# instructions between timer interrupts
+timer_interval = int(99.66e6 / 100)
+
+mask = 0xffffffff
+word = struct.Struct('<I')
+single = struct.Struct('<f')
+# both operands of float instructions are converted at once
+words2 = struct.Struct('<II')
+singles2 = struct.Struct('<ff')
+
+# the NaN produced by invalid operations on x86
+default_nan = 0xffc00000
+
+def signed(x):
+    return x - 0x100000000 if x & 0x80000000 else x
+
+def bitfloat(x):
+    return single.unpack(word.pack(x))[0]
+
+def bitint(f):
+    try:
+        return word.unpack(single.pack(f))[0]
+    except OverflowError:
+        return 0xff800000 if f < 0 else 0x7f800000
+
+# shift counts are taken mod 32, as x86 does for sim.c
+alu_table = {
+    0:  lambda a, t: (a + t) & mask,
+    1:  lambda a, t: (a - t) & mask,
+    2:  lambda a, t: (a << (t & 31)) & mask,
+    3:  lambda a, t: a >> (t & 31),
+    4:  lambda a, t: (signed(a) >> (t & 31)) & mask,
+    5:  lambda a, t: a & t,
+    6:  lambda a, t: a | t,
+    7:  lambda a, t: a ^ t,
+    8:  lambda a, t: (a + 4 * t) & mask,
+    22: lambda a, t: int(a < t),
+    23: lambda a, t: int(a <= t),
+    24: lambda a, t: int(a != t),
+    25: lambda a, t: int(a == t),
+    26: lambda a, t: int(signed(a) < signed(t)),
+    27: lambda a, t: int(signed(a) <= signed(t)),
+}
+
+def floats(a, b):
+    return singles2.unpack(words2.pack(a, b))
+
+# these compare rb itself, without the literal
+fcmp_table = {
+    30: lambda a, b: int(operator.lt(*floats(a, b))),
+    31: lambda a, b: int(operator.le(*floats(a, b))),
+}
+
+def finv(a, b):
+    f = bitfloat(a)
+    if f == 0:
+        return 0xff800000 if math.copysign(1, f) < 0 else 0x7f800000
+    return bitint(1.0 / f)
+
+def fsqrt(a, b):
+    f = bitfloat(a)
+    if f < 0:
+        return default_nan
+    return bitint(math.sqrt(f))
+
+def ftoi(a, b):
+    # round() rounds half away from zero, as roundf(); out of range
+    # conversions give 0x80000000 as on x86
+    f = round(bitfloat(a))
+    if not -0x80000000 <= f < 0x80000000:
+        return 0x80000000
+    return int(f) & mask
+
+def floor(a, b):
+    # floorf() returns NaNs unchanged, even signaling ones
+    f = bitfloat(a)
+    if f != f:
+        return a
+    return bitint(math.floor(f))
+
+fpu_table = {
+    0:  lambda a, b: bitint(operator.add(*floats(a, b))),
+    1:  lambda a, b: bitint(operator.sub(*floats(a, b))),
+    2:  lambda a, b: bitint(operator.mul(*floats(a, b))),
+    4:  finv,
+    5:  fsqrt,
+    6:  ftoi,
+    7:  lambda a, b: bitint(float(signed(a))),
+    8:  floor,
+}
+
+# sign mode -> (kept bits, flipped bits)
+sign_masks = {
+    0:  (0xffffffff, 0),
+    1:  (0xffffffff, 0x80000000),
+    2:  (0x7fffffff, 0),
+    3:  (0x7fffffff, 0x80000000),
+}
+
+io_regs = {
+    0x80001100: 'intr_addr',
+    0x80001104: 'intr_enabled',
+    0x80001108: 'epc',
+    0x8000110c: 'irq_num',
+    0x80001200: 'mmu_enabled',
+    0x80001204: 'pd_addr',
+}
+
+
+# ----------------------------------------------------------------------
+#       decoder
+# ----------------------------------------------------------------------
+
+# Each dec_* function returns the handler of one instruction word.  A
+# handler takes the pc and returns the next one.
+
+def dec_alu(sim, inst):
+    reg = sim.reg
+    tag, x, a, b = inst & 31, inst >> 23 & 31, inst >> 18 & 31, inst >> 13 & 31
+    if tag in fcmp_table:
+        f = fcmp_table[tag]
+        def fcmp(pc):
+            reg[x] = f(reg[a], reg[b])
+            return pc + 4
+        return fcmp
+    if tag not in alu_table:
+        raise SimError('instruction decode error (ALU)')
+    f = alu_table[tag]
+    lit = (inst >> 5 & 255) - (inst >> 5 & 128) * 2
+    def alu(pc):
+        reg[x] = f(reg[a], (reg[b] + lit) & mask)
+        return pc + 4
+    return alu
+
+def dec_fpu(sim, inst):
+    reg = sim.reg
+    tag, x, a, b = inst & 31, inst >> 23 & 31, inst >> 18 & 31, inst >> 13 & 31
+    if tag not in fpu_table:
+        raise SimError('instruction decode error (FPU)')
+    f = fpu_table[tag]
+    keep, flip = sign_masks[inst >> 5 & 3]
+    def fpu(pc):
+        r = (f(reg[a], reg[b]) & keep) ^ flip
+        reg[x] = 0 if r == 0x80000000 else r
+        return pc + 4
+    return fpu
+
+def misc_operands(inst):
+    d = inst & 0xffff
+    return inst >> 23 & 31, inst >> 18 & 31, d - (d & 0x8000) * 2
+
+def dec_ldl(sim, inst):
+    reg = sim.reg
+    x, a, d = misc_operands(inst)
+    d &= mask
+    def ldl(pc):
+        reg[x] = d
+        return pc + 4
+    return ldl
+
+def dec_ldh(sim, inst):
+    reg = sim.reg
+    x, a, d = misc_operands(inst)
+    d = d << 16 & mask
+    def ldh(pc):
+        reg[x] = d | reg[a] & 0xffff
+        return pc + 4
+    return ldh
+
+def dec_jl(sim, inst):
+    reg = sim.reg
+    x, a, d = misc_operands(inst)
+    d = (d << 2) + 4
+    def jl(pc):
+        reg[x] = pc + 4
+        return (pc + d) & mask
+    return jl
+
+def dec_jr(sim, inst):
+    reg = sim.reg
+    x, a, d = misc_operands(inst)
+    def jr(pc):
+        target = reg[a]
+        if target & 3:
+            raise SimError('jr: register corrupted: r%d' % a)
+        if sim.to_physical(target) >= sim.mem_size:
+            raise SimError('jr: jump destination out of range: r%d' % a)
+        reg[x] = pc + 4
+        return target
+    return jr
+
+def dec_ld(sim, inst):
+    reg, load = sim.reg, sim.load
+    x, a, d = misc_operands(inst)
+    d <<= 2
+    def ld(pc):
+        reg[x] = load((reg[a] + d) & mask)
+        return pc + 4
+    return ld
+
+def dec_ldb(sim, inst):
+    reg, load_byte = sim.reg, sim.load_byte
+    x, a, d = misc_operands(inst)
+    def ldb(pc):
+        reg[x] = load_byte((reg[a] + d) & mask)
+        return pc + 4
+    return ldb
+
+def dec_st(sim, inst):
+    reg, store = sim.reg, sim.store
+    x, a, d = misc_operands(inst)
+    d <<= 2
+    def st(pc):
+        store((reg[a] + d) & mask, reg[x])
+        return pc + 4
+    return st
+
+def dec_stb(sim, inst):
+    reg, store_byte = sim.reg, sim.store_byte
+    x, a, d = misc_operands(inst)
+    def stb(pc):
+        store_byte((reg[a] + d) & mask, reg[x])
+        return pc + 4
+    return stb
+
+def dec_debug(sim, inst):
+    # break/penv/ptrace do nothing, as in sim.c without -debug
+    def debug(pc):
+        return pc + 4
+    return debug
+
+def dec_sysenter(sim, inst):
+    def sysenter(pc):
+        sim.intr_enabled = 0
+        sim.irq_num = irq_sysenter
+        # the correct interrupted address, unlike other interrupts
+        sim.epc = pc + 4
+        return sim.intr_addr
+    return sysenter
+
+def dec_sysexit(sim, inst):
+    def sysexit(pc):
+        sim.intr_enabled = 1
+        return sim.epc
+    return sysexit
+
+def dec_bne(sim, inst):
+    reg = sim.reg
+    x, a, d = misc_operands(inst)
+    d = (d << 2) + 4
+    def bne(pc):
+        if reg[x] != reg[a]:
+            return (pc + d) & mask
+        return pc + 4
+    return bne
+
+def dec_beq(sim, inst):
+    reg = sim.reg
+    x, a, d = misc_operands(inst)
+    d = (d << 2) + 4
+    def beq(pc):
+        if reg[x] == reg[a]:
+            return (pc + d) & mask
+        return pc + 4
+    return beq
+
+decode_table = {
+    0:  dec_alu,
+    1:  dec_fpu,
+    2:  dec_ldl,
+    3:  dec_ldh,
+    4:  dec_jl,
+    5:  dec_jr,
+    6:  dec_ld,
+    7:  dec_ldb,
+    8:  dec_st,
+    9:  dec_stb,
+    10: dec_debug,
+    12: dec_sysenter,
+    13: dec_sysexit,
+    14: dec_bne,
+    15: dec_beq,
+}
+
+def halt(pc):
+    raise Halt()
+
+def decode(sim, inst):
+    if inst == halt_code:
+        return halt
+    if inst >> 28 not in decode_table:
+        raise SimError('instruction decode error')
+    return decode_table[inst >> 28](sim, inst)
+
+
+# ----------------------------------------------------------------------
+#       basic block translation
+# ----------------------------------------------------------------------
+
+# A basic block runs up to one of these instructions, the end of its page
+# or max_block instructions.  It is compiled into one Python function
+# which takes the pc of its first instruction and returns the next pc.
+
+terminators = [4, 5, 12, 13, 14, 15]
+
+max_block = 128
+
+class BlockExit(Exception):
+    # raised by a block after a store that may change what comes next
+    # (MMU or interrupt registers, or code); args are the next pc and the
+    # number of instructions run
+    pass
+
+# {a}, {b}: registers ra and rb; {t}: rb + literal, {tm}: the same in 32 bits
+alu_source = {
+    0:  '({a} + {t}) & 0xffffffff',
+    1:  '({a} - {t}) & 0xffffffff',
+    2:  '({a} << ({t} & 31)) & 0xffffffff',
+    3:  '{a} >> ({t} & 31)',
+    4:  '(({a} ^ 0x80000000) - 0x80000000 >> ({t} & 31)) & 0xffffffff',
+    5:  '{a} & {t}',
+    6:  '({a} | {t}) & 0xffffffff',
+    7:  '({a} ^ {t}) & 0xffffffff',
+    8:  '({a} + 4 * {t}) & 0xffffffff',
+    22: '1 if {a} < {tm} else 0',
+    23: '1 if {a} <= {tm} else 0',
+    24: '1 if {a} != {tm} else 0',
+    25: '1 if {a} == {tm} else 0',
+    26: '1 if ({a} ^ 0x80000000) < ({tm} ^ 0x80000000) else 0',
+    27: '1 if ({a} ^ 0x80000000) <= ({tm} ^ 0x80000000) else 0',
+    30: '1 if fa < fb else 0',
+    31: '1 if fa <= fb else 0',
+}
+
+fpu_source = {
+    0:  'bitint(fa + fb)',
+    1:  'bitint(fa - fb)',
+    2:  'bitint(fa * fb)',
+}
+
+class BlockSource(object):
+    # Python source of a block.  Registers are kept in locals r0..r31,
+    # read from reg on first use and written back before the block
+    # returns or calls out where an error may be raised.
+    def __init__(self, sim):
+        self.sim = sim
+        self.body = []
+        self.lines = [0, 0]
+        self.loaded = set()
+        self.dirty = set()
+        self.env = {'reg': sim.reg, 'mem': sim.mem, 'code': sim.code, 'load': sim.load,
+                    'load_byte': sim.load_byte, 'store': sim.store, 'store_byte': sim.store_byte,
+                    'bitint': bitint, 'pair_i': words2.pack, 'pair_f': singles2.unpack,
+                    'BlockExit': BlockExit}
+
+    def use(self, *regs):
+        for r in regs:
+            if r not in self.loaded:
+                self.body.append('r%d = reg[%d]' % (r, r))
+                self.loaded.add(r)
+        return ['r%d' % r for r in regs]
+
+    def set(self, r):
+        self.loaded.add(r)
+        self.dirty.add(r)
+        return 'r%d' % r
+
+    def writeback(self):
+        return '; '.join('reg[%d] = r%d' % (r, r) for r in sorted(self.dirty)) or 'pass'
+
+    def add(self, i, inst, handler):
+        # appends the i-th instruction; handler is its decoded handler,
+        # called for the rare instructions
+        start = len(self.body)
+        self.inst(i, inst, handler)
+        self.lines += [i] * (len(self.body) - start)
+
+    def inst(self, i, inst, handler):
+        body = self.body
+        op = inst >> 28
+        x, a = inst >> 23 & 31, inst >> 18 & 31
+        next_pc = 4 * i + 4
+        if op == 0:
+            tag, b = inst & 31, inst >> 13 & 31
+            ra, rb = self.use(a, b)
+            lit = (inst >> 5 & 255) - (inst >> 5 & 128) * 2
+            t = '(%s + %d)' % (rb, lit) if lit else rb
+            tm = '(%s & 0xffffffff)' % t if lit else t
+            if tag in fcmp_table:
+                body.append('fa, fb = pair_f(pair_i(%s, %s))' % (ra, rb))
+            body.append('%s = %s' % (self.set(x), alu_source[tag].format(a=ra, t=t, tm=tm)))
+            return
+        if op == 1:
+            tag, b = inst & 31, inst >> 13 & 31
+            ra, rb = self.use(a, b)
+            keep, flip = sign_masks[inst >> 5 & 3]
+            if tag in fpu_source:
+                body.append('fa, fb = pair_f(pair_i(%s, %s))' % (ra, rb))
+                body.append('t = ' + fpu_source[tag])
+            else:
+                self.env['fpu%d' % tag] = fpu_table[tag]
+                body.append('t = fpu%d(%s, %s)' % (tag, ra, rb))
+            if keep != mask or flip:
+                body.append('t = (t & %#x) ^ %#x' % (keep, flip))
+            body.append('%s = 0 if t == 0x80000000 else t' % self.set(x))
+            return
+        d = (inst & 0xffff) - (inst & 0x8000) * 2
+        target = 4 * i + (d << 2) + 4
+        if op == 2:
+            body.append('%s = %d' % (self.set(x), d & mask))
+        elif op == 3:
+            ra, = self.use(a)
+            body.append('%s = %d | %s & 0xffff' % (self.set(x), d << 16 & mask, ra))
+        elif op == 4:
+            body.append('%s = pc + %d' % (self.set(x), next_pc))
+            body.append('%s; return (pc + %d) & 0xffffffff' % (self.writeback(), target))
+        elif op == 6:
+            ra, = self.use(a)
+            body.append('addr = (%s + %d) & 0xffffffff' % (ra, d << 2))
+            if not self.sim.mmu_enabled:
+                # words of memory are read in place
+                writeback = self.writeback()
+                body.append('if addr < %d and not addr & 3: %s = mem[addr >> 2]' % (self.sim.mem_size, self.set(x)))
+                body.append('else: %s; %s = load(addr)' % (writeback, self.set(x)))
+            else:
+                body.append(self.writeback())
+                body.append('%s = load(addr)' % self.set(x))
+        elif op == 7:
+            ra, = self.use(a)
+            body.append(self.writeback())
+            body.append('%s = load_byte((%s + %d) & 0xffffffff)' % (self.set(x), ra, d))
+        elif op == 8 or op == 9:
+            ra, rx = self.use(a, x)
+            exit = 'raise BlockExit(pc + %d, %d)' % (next_pc, i + 1)
+            if op == 8 and not self.sim.mmu_enabled:
+                body.append('addr = (%s + %d) & 0xffffffff' % (ra, d << 2))
+                body.append('if addr < %d and not addr & 3 and not code[addr >> 2]: mem[addr >> 2] = %s' %
+                            (self.sim.mem_size, rx))
+                body.append('else:')
+                if self.dirty:
+                    body.append('    ' + self.writeback())
+                body.append('    if store(addr, %s): %s' % (rx, exit))
+            else:
+                body.append(self.writeback())
+                body.append('if %s((%s + %d) & 0xffffffff, %s): %s' %
+                            ('store' if op == 8 else 'store_byte', ra, d << (2 if op == 8 else 0), rx, exit))
+        elif op == 10:
+            body.append('pass')
+        elif op == 14 or op == 15:
+            rx, ra = self.use(x, a)
+            body.append('if %s %s %s: %s; return (pc + %d) & 0xffffffff' %
+                        (rx, '!=' if op == 14 else '==', ra, self.writeback(), target))
+            body.append('%s; return pc + %d' % (self.writeback(), next_pc))
+        elif op == 5 and not self.sim.mmu_enabled:
+            # jr; the handler reports bad destinations
+            ra, = self.use(a)
+            body.append('%s; t = %s' % (self.writeback(), ra))
+            body.append('if t & 3 or t >= %d: return h%d(pc + %d)' % (self.sim.mem_size, i, 4 * i))
+            body.append('reg[%d] = pc + %d; return t' % (x, next_pc))
+            self.env['h%d' % i] = handler
+        else:
+            # jr, sysenter, sysexit
+            body.append(self.writeback())
+            body.append('return h%d(pc + %d)' % (i, 4 * i))
+            self.env['h%d' % i] = handler
+
+    def compile(self, name):
+        names = sorted(self.env)
+        source = 'def block(pc, %s):\n' % ', '.join('%s=%s' % (name, name) for name in names)
+        source += ''.join('    %s\n' % line for line in self.body)
+        exec compile(source, name, 'exec') in self.env
+        block = self.env['block']
+        block.lines = self.lines
+        return block
+
+def translate(sim, phys):
+    # returns the function running the block at physical address phys and
+    # its length; the function's lines attribute maps line numbers to
+    # instructions, to find the pc of an error
+    mem = sim.mem
+    if mem[phys >> 2] == halt_code:
+        return halt, 0
+    source = BlockSource(sim)
+    n = 0
+    ended = False
+    end = min((phys | 0xfff) + 1, phys + 4 * max_block)
+    for addr in range(phys, end, 4):
+        inst = mem[addr >> 2]
+        if inst == halt_code:
+            break
+        try:
+            handler = decode(sim, inst)
+        except SimError:
+            # raised when the block starting there is run
+            if n == 0:
+                raise
+            break
+        source.add(n, inst, handler)
+        n += 1
+        if inst >> 28 in terminators:
+            ended = True
+            break
+    if not ended:
+        source.body.append('%s; return pc + %d' % (source.writeback(), 4 * n))
+        source.lines.append(n - 1)
+    return source.compile('<block %#x>' % phys), n
+
+
+# ----------------------------------------------------------------------
+#       simulator
+# ----------------------------------------------------------------------
+
+class Simulator(object):
+    def __init__(self, mem_size=0x400000, interrupts=True, input='', output=None, translate=False):
+        # input is the whole serial input; output takes the serial output;
+        # with translate, basic blocks are run as compiled functions
+        self.mem_size = mem_size
+        self.interrupts = interrupts
+        self.translate = translate
+        self.input = input
+        self.input_pos = 0
+        self.output = sys.stdout if output is None else output
+        self.reg = [0] * 32
+        self.mem = array.array('I', '\0' * mem_size)
+        # handlers of the words decoded so far, by physical word address
+        self.decoded = [None] * (mem_size >> 2)
+        # translated blocks by physical address, their addresses by page,
+        # and marks on the words decoded or translated, which stores check
+        self.blocks = {}
+        self.page_blocks = {}
+        self.code = bytearray(mem_size >> 2)
+        self.pc = 0x2000
+        self.inst_cnt = 0
+        self.intr_addr = 0
+        self.intr_enabled = 0
+        self.epc = 0
+        self.irq_num = 0
+        self.irq_bits = 0
+        self.mmu_enabled = 0
+        self.pd_addr = 0
+        self.tick = 0
+
+    def load_image(self, image, entry_point=0x2000, init_stack=True):
+        # places image at entry_point and starts there, as sim.c does with
+        # an a.out (init_stack=False for -boot-test)
+        end = entry_point + len(image)
+        if end > self.mem_size:
+            raise SimError('load_file: program exceeds %dMB limit' % (self.mem_size >> 20))
+        n = len(image) & ~3
+        words = array.array('I', str(image[:n]))
+        if sys.byteorder == 'big':
+            words.byteswap()
+        i = entry_point >> 2
+        self.mem[i:i + len(words)] = words
+        for addr in range(entry_point + n, end):
+            self.store_byte(addr, image[addr - entry_point])
+        self.decoded[i:(end + 3) >> 2] = [None] * (((end + 3) >> 2) - i)
+        self.flush()
+        if init_stack:
+            self.reg[30] = self.reg[31] = self.mem_size
+        self.pc = entry_point
+
+    def load_program(self, program):
+        # an asm.Program, as returned by Assembler.assemble()
+        self.load_image(program.image, program.entry_point)
+
+    def to_physical(self, addr):
+        # error messages start with 'to_physical: ', see print_env()
+        if not self.mmu_enabled:
+            return addr
+        mem, mem_size = self.mem, self.mem_size
+        tmp = self.pd_addr | (addr >> 22) << 2
+        if tmp & 3 or tmp >= mem_size:
+            raise SimError('to_physical: PDE address error: 0x%08x, Requested virtual address: 0x%08x' % (tmp, addr))
+        tmp = mem[tmp >> 2]
+        if tmp & 1 == 0:
+            raise SimError('to_physical: invalid PDE, Requested virtual address: 0x%08x' % addr)
+        tmp = (tmp & ~0x0fff) | (addr >> 12 & 0x03ff) << 2
+        if tmp >= mem_size:
+            raise SimError('to_physical: PTE address error: 0x%08x, Requested virtual address: 0x%08x' % (tmp, addr))
+        tmp = mem[tmp >> 2]
+        if tmp & 1 == 0:
+            raise SimError('to_physical: invalid PTE, Requested virtual address: 0x%08x' % addr)
+        tmp = (tmp & ~0x0fff) | (addr & 0x0fff)
+        if tmp & 0x3000 != addr & 0x3000:
+            raise SimError('to_physical: invalid page color: Physical adrress: 0x%08x, Requested virtual address: 0x%08x' % (tmp, addr))
+        return tmp
+
+    def serial_read(self):
+        if self.input_pos == len(self.input):
+            return mask
+        self.input_pos += 1
+        return ord(self.input[self.input_pos - 1])
+
+    def serial_write(self, x):
+        self.output.write(chr(x & 255))
+
+    def load(self, addr):
+        if self.mmu_enabled:
+            addr = self.to_physical(addr)
+        if addr & 3:
+            raise SimError('load: address must be a multiple of 4: 0x%08x' % addr)
+        if addr < self.mem_size:
+            return self.mem[addr >> 2]
+        if addr == 0x80001000:
+            return self.serial_read()
+        if addr == 0x80001004:
+            return 1 # Tx ready bit is already high in simulation
+        if addr in io_regs:
+            return getattr(self, io_regs[addr])
+        raise SimError('load: exceeded %dMB limit: 0x%08x' % (self.mem_size >> 20, addr))
+
+    def load_byte(self, addr):
+        if self.mmu_enabled:
+            addr = self.to_physical(addr)
+        if addr >= self.mem_size:
+            raise SimError('load_byte: exceeded %dMB limit: 0x%08x' % (self.mem_size >> 20, addr))
+        b = self.mem[addr >> 2] >> ((addr & 3) << 3) & 255
+        return b | 0xffffff00 if b & 0x80 else b
+
+    def store(self, addr, x):
+        if self.mmu_enabled:
+            addr = self.to_physical(addr)
+        if addr & 3:
+            raise SimError('store: address must be a multiple of 4: 0x%08x' % addr)
+        if addr < self.mem_size:
+            self.mem[addr >> 2] = x
+            if self.code[addr >> 2]:
+                return self.invalidate(addr >> 2)
+        elif addr == 0x80001000:
+            self.serial_write(x)
+        elif addr in io_regs:
+            setattr(self, io_regs[addr], x)
+            if addr >= 0x80001200:
+                self.flush()
+            return True
+        else:
+            raise SimError('store: exceeded %dMB limit: 0x%08x' % (self.mem_size >> 20, addr))
+
+    def store_byte(self, addr, x):
+        if self.mmu_enabled:
+            addr = self.to_physical(addr)
+        if addr >= self.mem_size:
+            raise SimError('store_byte: exceeded %dMB limit: 0x%08x' % (self.mem_size >> 20, addr))
+        shift = (addr & 3) << 3
+        self.mem[addr >> 2] = self.mem[addr >> 2] & ~(255 << shift) | (x & 255) << shift
+        if self.code[addr >> 2]:
+            return self.invalidate(addr >> 2)
+
+    # Stores return True when the code or the MMU or interrupt state may
+    # have changed, which ends a translated block.
+
+    def invalidate(self, i):
+        # a store to word i, decoded or translated before
+        self.decoded[i] = None
+        for addr in self.page_blocks.pop(i >> 10, ()):
+            del self.blocks[addr]
+        return True
+
+    def flush(self):
+        # blocks depend on the MMU being enabled, see BlockSource.inst()
+        self.blocks.clear()
+        self.page_blocks.clear()
+
+    def block(self, phys):
+        block = self.blocks[phys] = translate(self, phys)
+        self.page_blocks.setdefault(phys >> 12, []).append(phys)
+        self.code[phys >> 2:(phys >> 2) + max(block[1], 1)] = '\1' * max(block[1], 1)
+        return block
+
+    def interrupt(self, pc):
+        # returns the pc to continue from
+        self.tick += 1
+        if self.tick >= timer_interval:
+            self.irq_bits |= 1 << irq_timer
+            self.tick = 0
+        if self.input_pos < len(self.input):
+            self.irq_bits |= 1 << irq_serial
+        if self.irq_bits and self.intr_enabled:
+            self.intr_enabled = 0
+            # GAIA cpus store interrupted address + 4
+            self.epc = (pc + 4) & mask
+            self.irq_num = (self.irq_bits & -self.irq_bits).bit_length() - 1
+            self.irq_bits &= ~(1 << self.irq_num) # auto EOI
+            return self.intr_addr
+        return pc
+
+    def run(self, limit=None):
+        # runs until halt and returns True; with limit, returns False
+        # after that many instructions if not halted by then
+        if self.translate:
+            return self.run_blocks(limit)
+        mem, decoded, code, mem_size = self.mem, self.decoded, self.code, self.mem_size
+        interrupts = self.interrupts
+        stop = -1 if limit is None else limit
+        pc = self.pc
+        n = 0
+        try:
+            while n != stop:
+                if interrupts:
+                    pc = self.interrupt(pc)
+                phys = self.to_physical(pc) if self.mmu_enabled else pc
+                if phys >= mem_size:
+                    raise SimError('program counter out of range')
+                handler = decoded[phys >> 2]
+                if handler is None:
+                    handler = decoded[phys >> 2] = decode(self, mem[phys >> 2])
+                    code[phys >> 2] = 1
+                pc = handler(pc)
+                n += 1
+            return False
+        except Halt:
+            return True
+        finally:
+            self.pc = pc
+            self.inst_cnt += n
+
+    def run_blocks(self, limit):
+        # same as run(), a block at a time; instructions are run one by one
+        # where an interrupt may be taken or limit be reached in a block
+        mem, decoded, code, blocks, mem_size = self.mem, self.decoded, self.code, self.blocks, self.mem_size
+        interrupts = self.interrupts
+        stop = sys.maxint if limit is None else limit
+        pc = self.pc
+        n = 0
+        block = None
+        try:
+            while True:
+                phys = self.to_physical(pc) if self.mmu_enabled else pc
+                if phys >= mem_size:
+                    raise SimError('program counter out of range')
+                block, length = blocks.get(phys) or self.block(phys)
+                pending = interrupts and self.input_pos < len(self.input)
+                if n + length >= stop or interrupts and self.intr_enabled and \
+                   (self.irq_bits or pending or self.tick + length >= timer_interval):
+                    block = None
+                    if n == stop:
+                        return False
+                    if interrupts:
+                        pc = self.interrupt(pc)
+                        phys = self.to_physical(pc) if self.mmu_enabled else pc
+                        if phys >= mem_size:
+                            raise SimError('program counter out of range')
+                    handler = decoded[phys >> 2]
+                    if handler is None:
+                        handler = decoded[phys >> 2] = decode(self, mem[phys >> 2])
+                        code[phys >> 2] = 1
+                    pc = handler(pc)
+                    n += 1
+                    continue
+                try:
+                    pc = block(pc)
+                except BlockExit as e:
+                    pc, length = e.args
+                n += length
+                if interrupts:
+                    # no interrupt was taken in the block, the checks before
+                    # its instructions only set irq_bits
+                    if pending:
+                        self.irq_bits |= 1 << irq_serial
+                    self.tick += length
+                    if self.tick >= timer_interval:
+                        self.irq_bits |= 1 << irq_timer
+                        self.tick -= timer_interval
+        except Halt:
+            return True
+        except SimError:
+            # the pc and count of the instruction that failed in a block
+            tb = sys.exc_info()[2]
+            while tb is not None and block is not None and tb.tb_frame.f_code is not block.func_code:
+                tb = tb.tb_next
+            if tb is not None and block is not None:
+                pc += 4 * block.lines[tb.tb_lineno]
+                n += block.lines[tb.tb_lineno]
+            raise
+        finally:
+            self.pc = pc
+            self.inst_cnt += n
+
+
+# ----------------------------------------------------------------------
+#       command line
+# ----------------------------------------------------------------------
+
+def read_image(data):
+    # the image of an a.out file, in any of the formats of asm.write_image()
+    eof = 'load_file: reached EOF (actual size is less than header)'
+    if len(data) < 4:
+        raise SimError(eof)
+    size, = word.unpack_from(data)
+    ofs = 4
+    if size & 0x40000000:
+        # compressed image (-z): literal runs and back references
+        size &= 0x3fffffff
+        image = bytearray()
+        while len(image) < size:
+            if ofs >= len(data):
+                raise SimError(eof)
+            t = ord(data[ofs])
+            if t < 0x80:
+                n = t + 1
+                if n > size - len(image):
+                    raise SimError('load_file: broken compressed image')
+                if ofs + 1 + n > len(data):
+                    raise SimError(eof)
+                image += data[ofs + 1:ofs + 1 + n]
+                ofs += 1 + n
+            else:
+                if ofs + 3 > len(data):
+                    raise SimError(eof)
+                dist, = struct.unpack_from('<H', data, ofs + 1)
+                n = (t & 0x7f) + 3
+                if dist == 0 or dist > len(image) or n > size - len(image):
+                    raise SimError('load_file: broken compressed image')
+                if dist >= n:
+                    image += image[len(image) - dist:len(image) - dist + n]
+                else:
+                    for _ in range(n):
+                        image.append(image[-dist])
+                ofs += 3
+    elif size & 0x80000000:
+        # chunked image: zero-filled (.zero/.bss) ranges are not stored
+        size &= 0x7fffffff
+        image = bytearray(size)
+        i = 0
+        while i < size:
+            if ofs + 4 > len(data):
+                raise SimError(eof)
+            n, = word.unpack_from(data, ofs)
+            ofs += 4
+            zero = n >> 31
+            n &= 0x7fffffff
+            if n == 0 or n > size - i:
+                raise SimError('load_file: broken chunk header')
+            if not zero:
+                if ofs + n > len(data):
+                    raise SimError(eof)
+                image[i:i + n] = data[ofs:ofs + n]
+                ofs += n
+            i += n
+    else:
+        if ofs + size > len(data):
+            raise SimError(eof)
+        image = bytearray(data[ofs:ofs + size])
+        ofs += size
+    if ofs != len(data):
+        raise SimError('load_file: input file remained (actual size is more than header)')
+    return image
+
+def print_env(f, sim, show_stat, show_vpc):
+    f.write('\x1b[1m*** Simulator Status ***\x1b[0m\n')
+    if show_stat:
+        f.write('<register>\n')
+        for i in range(16):
+            f.write('  r%-2d: %11d (0x%08x) / r%-2d: %11d (0x%08x)\n' %
+                    (i, signed(sim.reg[i]), sim.reg[i], i + 16, signed(sim.reg[i + 16]), sim.reg[i + 16]))
+    if sim.mmu_enabled:
+        f.write('<Current Virtual PC>: 0x%08x\n' % sim.pc)
+        if show_vpc:
+            f.write('<Current Physical PC>: 0x%06x\n' % sim.to_physical(sim.pc))
+    else:
+        f.write('<Current PC>: 0x%06x\n' % sim.pc)
+    f.write('<Number of executed instructions>: %d\n' % sim.inst_cnt)
+
+def main(argv=None):
+    argparser = argparse.ArgumentParser(usage='%(prog)s [options] file...')
+    argparser.add_argument('inputs', nargs='+', help='a.out file, or sources to assemble in memory', metavar='file...')
+    argparser.add_argument('-l', help='with sources, set library file to <file>', metavar='<file>', action='append')
+    argparser.add_argument('-boot-test', help='bootloader test mode', action='store_true')
+    argparser.add_argument('-msize', help='change memory size (MB)', metavar='<integer>', default=4, type=int)
+    argparser.add_argument('-no-interrupt', help='disable interrupt feature', action='store_true')
+    argparser.add_argument('-simple', help='same as -no-interrupt', action='store_true')
+    argparser.add_argument('-stat', help='show simulator status', action='store_true')
+    argparser.add_argument('-translate', help='run basic blocks translated to Python', action='store_true')
+    argparser.add_argument('-limit', help='stop with an error after <integer> instructions', metavar='<integer>', type=int)
+    args = argparser.parse_args(argv)
+
+    # the serial input is read before starting
+    sim = Simulator(mem_size=args.msize << 20, interrupts=not (args.no_interrupt or args.simple),
+                    input=sys.stdin.read(), translate=args.translate)
+    try:
+        if all(os.path.splitext(filename)[1] == '.s' for filename in args.inputs):
+            assembler = asm.Assembler(warn_unused_label=False)
+            try:
+                program = assembler.assemble(args.inputs, args.l or [])
+            except asm.AsmError as e:
+                map(asm.report_warning, assembler.warnings)
+                asm.report_error(e)
+                return 1
+            map(asm.report_warning, program.warnings)
+            image, entry_point = program.image, program.entry_point
+        elif len(args.inputs) == 1:
+            with open(args.inputs[0], 'rb') as f:
+                image, entry_point = read_image(f.read()), 0x2000
+        else:
+            argparser.error('multiple input files are specified')
+        if args.boot_test:
+            sim.load_image(image, 0, init_stack=False)
+        else:
+            sim.load_image(image, entry_point)
+        print >> sys.stderr, '[info] program successfully loaded'
+        if not sim.run(args.limit):
+            raise SimError('instruction limit exceeded')
+    except (SimError, IOError) as e:
+        sys.stdout.flush()
+        msg = e.strerror if isinstance(e, IOError) else str(e)
+        sys.stderr.write('\x1b[1;31mruntime error: \x1b[39m%s\x1b[0m\n\n' % msg)
+        print_env(sys.stderr, sim, args.stat, not msg.startswith('to_physical: '))
+        return 1
+    finally:
+        sys.stdout.flush()
+    if args.stat:
+        print_env(sys.stderr, sim, True, True)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())